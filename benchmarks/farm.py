@@ -0,0 +1,171 @@
+"""
+A local farm of mock Sci-Hub mirrors, SciDB and arXiv for benchmarking.
+
+Landing pages are built from the HTML fixtures in tests/documents, with their
+PDF links pointed back at the farm. Every mirror listens on its own port, so
+per-host connection limits apply as they would against real mirrors. The
+farm runs in its own process, so that it doesn't skew the CPU time and
+memory measured in the benchmark.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import random
+
+from aiohttp import web
+from parse.parse import find_pdf_url
+
+DOCUMENTS_DIR = os.path.join(os.path.dirname(__file__), "..", "tests", "documents")
+
+# PDFs are sent in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+NOT_FOUND_PAGE = "<html><body><p>Article not found</p></body></html>"
+
+
+def read_template(name: str) -> str:
+    "Read a fixture page and replace its PDF link with a placeholder"
+
+    with open(os.path.join(DOCUMENTS_DIR, name)) as f:
+        page = f.read()
+    return page.replace(find_pdf_url(page), "{pdf_url}")
+
+
+class MirrorFarm:
+    """
+    Serves landing pages and PDFs with tunable latency, errors and sizes.
+
+    latency is the mean delay in seconds before each response, varied by up
+    to +/- jitter of itself. error_rate is the share of requests answered
+    with a 503, and miss_rate the share of landing pages that don't have the
+    paper.
+    """
+
+    def __init__(
+        self,
+        mirrors: int = 3,
+        latency: float = 0.05,
+        jitter: float = 0.5,
+        error_rate: float = 0.0,
+        miss_rate: float = 0.0,
+        pdf_size: int = 1024 * 1024,
+        seed: int = 0,
+    ):
+        self.mirrors = mirrors
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.miss_rate = miss_rate
+        self.pdf_size = pdf_size
+        self.random = random.Random(seed)
+        self.scihub_page = read_template("scihub.html")
+        self.scidb_page = read_template("scidb.html")
+
+    async def delay(self) -> None:
+        spread = self.jitter * (2 * self.random.random() - 1)
+        await asyncio.sleep(max(self.latency * (1 + spread), 0))
+
+    def fail(self) -> web.Response | None:
+        "Returns an error response, or None if the request should succeed"
+
+        if self.random.random() >= self.error_rate:
+            return None
+        return web.Response(status=503, text="Service Unavailable")
+
+    async def landing_page(self, request, template: str) -> web.Response:
+        await self.delay()
+        error = self.fail()
+        if error is not None:
+            return error
+        if self.random.random() < self.miss_rate:
+            return web.Response(text=NOT_FOUND_PAGE, content_type="text/html")
+
+        pdf_url = f"http://{request.host}/files/{request.match_info['id']}.pdf"
+        page = template.replace("{pdf_url}", pdf_url)
+        return web.Response(text=page, content_type="text/html")
+
+    async def scihub(self, request) -> web.Response:
+        return await self.landing_page(request, self.scihub_page)
+
+    async def scidb(self, request) -> web.Response:
+        return await self.landing_page(request, self.scidb_page)
+
+    async def pdf(self, request) -> web.StreamResponse:
+        "Send a PDF of pdf_size bytes that's different for every identifier"
+
+        await self.delay()
+        error = self.fail()
+        if error is not None:
+            return error
+
+        head = b"%PDF-1.4\n%" + request.match_info["id"].encode() + b"\n"
+        body = head + b"0" * max(self.pdf_size - len(head), 0)
+
+        res = web.StreamResponse()
+        res.content_type = "application/pdf"
+        res.content_length = len(body)
+        try:
+            await res.prepare(request)
+            for i in range(0, len(body), CHUNK_SIZE):
+                await res.write(body[i : i + CHUNK_SIZE])
+        except ConnectionResetError:
+            # the client dropped the request after another mirror won the race
+            pass
+        return res
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/scihub/{id:.*}", self.scihub)
+        app.router.add_get("/scidb/{id:.*}", self.scidb)
+        app.router.add_get("/arxiv/pdf/{id:.*}.pdf", self.pdf)
+        app.router.add_get("/files/{id:.*}.pdf", self.pdf)
+        return app
+
+    async def start(self) -> tuple[web.AppRunner, dict]:
+        """
+        Start a site per mirror, and for SciDB and arXiv. Returns the runner
+        and the base URLs of the providers.
+        """
+
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+
+        async def start_site() -> str:
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            host, port = site._server.sockets[0].getsockname()[:2]
+            return f"http://{host}:{port}"
+
+        urls = {
+            "scihub": [await start_site() + "/scihub/" for _ in range(self.mirrors)],
+            "scidb": await start_site() + "/scidb/",
+            "arxiv": await start_site() + "/arxiv/pdf/{}.pdf",
+        }
+        return runner, urls
+
+
+def run_farm(conn, config: dict) -> None:
+    async def serve():
+        runner, urls = await MirrorFarm(**config).start()
+        conn.send(urls)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(serve())
+
+
+def start_farm(**config) -> tuple[multiprocessing.Process, dict]:
+    """
+    Run a MirrorFarm with the given settings in another process. Returns the
+    process, to terminate when done, and the base URLs of the providers.
+    """
+
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=run_farm, args=(child_conn, config), daemon=True
+    )
+    process.start()
+    return process, conn.recv()
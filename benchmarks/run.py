@@ -0,0 +1,292 @@
+"""
+Benchmarks papers-dl against a local farm of mock mirrors (see farm.py), so
+that results don't depend on the network or on which mirrors are up, and
+times the parsers on the pages in tests/documents.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run --papers 200 --jobs 16 -o results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import timeit
+
+from loguru import logger
+
+from benchmarks.farm import DOCUMENTS_DIR, start_farm
+
+# fixture pages that find_pdf_url is timed on
+LANDING_PAGES = ("scihub.html", "scidb.html", "arxiv.html")
+
+
+def percentile(samples: list[float], p: float) -> float | None:
+    "Returns the p-th percentile of samples, by nearest rank"
+
+    if not samples:
+        return None
+    samples = sorted(samples)
+    rank = max(round(p / 100 * len(samples)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def peak_rss() -> int:
+    "Returns the peak resident memory of this process in bytes"
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def identifiers(papers: int, arxiv_share: float) -> list[str]:
+    "Returns a mix of DOIs and arXiv ids that the farm has papers for"
+
+    arxiv_papers = round(papers * arxiv_share)
+    return [
+        f"arXiv:2401.{i:05d}" if i < arxiv_papers else f"10.5555/bench.{i}"
+        for i in range(papers)
+    ]
+
+
+def connection_counter(counts: dict):
+    "Returns a TraceConfig counting requests and new connections into counts"
+
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        counts["requests"] += 1
+
+    async def on_connection_create_end(session, context, params):
+        counts["connections"] += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        counts["reused_connections"] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+def use_farm(urls: dict) -> None:
+    "Point every provider at the farm, bypassing Sci-Hub mirror discovery"
+
+    import providers.arxiv as arxiv
+    import providers.health as health
+    import providers.scidb as scidb
+    import providers.scihub as scihub
+
+    scihub._mirrors = urls["scihub"]
+    scihub._mirrors_updated = None
+    scidb.SCIDB_URL = urls["scidb"]
+    arxiv.ARXIV_PDF_URL = urls["arxiv"]
+    health._health = None
+
+
+async def bench_fetch(ids: list[str], jobs: int, per_host: int, out_dir: str) -> dict:
+    """
+    Download every paper in ids from the farm, at most `jobs` at a time, and
+    time each download and each of its stages.
+    """
+
+    import metrics
+    from fetch.fetch import download_paper
+    from session import create_session
+
+    run_metrics = metrics.get_metrics()
+    run_metrics.enabled = True
+
+    counts = {"requests": 0, "connections": 0, "reused_connections": 0}
+    semaphore = asyncio.Semaphore(jobs)
+    latencies = []
+
+    async def download(session, identifier) -> bool:
+        async with semaphore:
+            start = time.perf_counter()
+            result = await download_paper(
+                session, identifier, "all", out_dir, rename=False
+            )
+            latencies.append(time.perf_counter() - start)
+            return result is not None
+
+    start = time.perf_counter()
+    async with create_session(
+        jobs * 4, per_host, trace_configs=[connection_counter(counts)]
+    ) as session:
+        found = await asyncio.gather(*(download(session, id) for id in ids))
+    elapsed = time.perf_counter() - start
+
+    summary = run_metrics.summary()
+    return {
+        "papers": len(ids),
+        "found": sum(found),
+        "seconds": elapsed,
+        "papers_per_second": len(ids) / elapsed,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=None),
+        },
+        **counts,
+        "peak_rss": peak_rss(),
+        "stages": summary["stages"],
+        "counters": summary["counters"],
+    }
+
+
+def time_call(call, number: int) -> float:
+    "Returns the best time per call in seconds out of a few rounds"
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def bench_parse(number: int) -> dict:
+    "Time the identifier and PDF link parsers on the fixture pages"
+
+    from parse.parse import find_pdf_url, parse_ids_from_text
+
+    texts = []
+    for name in sorted(os.listdir(DOCUMENTS_DIR)):
+        with open(os.path.join(DOCUMENTS_DIR, name)) as f:
+            texts.append(f.read())
+    text = "\n".join(texts)
+
+    seconds = time_call(lambda: parse_ids_from_text(text), number)
+    results = {
+        "parse_ids_from_text": {
+            "bytes": len(text.encode()),
+            "seconds": seconds,
+            "megabytes_per_second": len(text.encode()) / seconds / 1e6,
+        },
+        "find_pdf_url": {},
+    }
+    for name in LANDING_PAGES:
+        with open(os.path.join(DOCUMENTS_DIR, name)) as f:
+            page = f.read()
+        results["find_pdf_url"][name] = {
+            "seconds": time_call(lambda: find_pdf_url(page), number * 10)
+        }
+    return results
+
+
+def run(args) -> dict:
+    from version import __version__
+
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "config": vars(args),
+    }
+
+    if not args.skip_parse:
+        results["parse"] = bench_parse(args.number)
+
+    if not args.skip_fetch:
+        farm, urls = start_farm(
+            mirrors=args.mirrors,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            miss_rate=args.miss_rate,
+            pdf_size=args.pdf_size,
+            seed=args.seed,
+        )
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                # keep the mirror health, miss cache and downloads of a run
+                # from leaking into the next
+                os.environ["PAPERS_DL_CACHE_DIR"] = os.path.join(tmp, "cache")
+                import fetch.misses as misses
+
+                misses.get_misses().ttl = 0
+                use_farm(urls)
+                ids = identifiers(args.papers, args.arxiv_share)
+                results["fetch"] = asyncio.run(
+                    bench_fetch(ids, args.jobs, args.per_host, os.path.join(tmp, "out"))
+                )
+        finally:
+            farm.terminate()
+            farm.join()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark papers-dl against a local mock mirror farm"
+    )
+    parser.add_argument(
+        "--papers", type=int, default=100, help="number of papers to fetch"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help="papers fetched at once"
+    )
+    parser.add_argument(
+        "--per-host", type=int, default=4, help="connections per mirror"
+    )
+    parser.add_argument(
+        "--mirrors", type=int, default=3, help="number of Sci-Hub mirrors"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="mean seconds before the farm answers a request",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of requests the farm fails with a 503",
+    )
+    parser.add_argument(
+        "--miss-rate",
+        type=float,
+        default=0.0,
+        help="share of landing pages without the paper",
+    )
+    parser.add_argument(
+        "--pdf-size", type=int, default=1024 * 1024, help="size of each PDF in bytes"
+    )
+    parser.add_argument(
+        "--arxiv-share",
+        type=float,
+        default=0.2,
+        help="share of papers that are arXiv papers",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the farm")
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=20,
+        help="calls per round in the parsing benchmarks",
+    )
+    parser.add_argument("--skip-fetch", action="store_true")
+    parser.add_argument("--skip-parse", action="store_true")
+    parser.add_argument(
+        "-o", "--output", default=None, help="file to write the JSON results to"
+    )
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR", format="{message}")
+
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
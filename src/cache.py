@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+
+from loguru import logger
+
+
+def cache_dir() -> str:
+    """
+    Returns the directory papers-dl keeps its persistent state in, creating it
+    if needed. Defaults to $XDG_CACHE_HOME/papers-dl and can be overridden
+    with $PAPERS_DL_CACHE_DIR.
+    """
+
+    path = os.environ.get("PAPERS_DL_CACHE_DIR")
+    if not path:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        path = os.path.join(base, "papers-dl")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_json(name: str):
+    "Read a JSON file from the cache directory. Returns None if it's missing."
+
+    path = os.path.join(cache_dir(), name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.info("Ignoring unreadable cache file {}: {}", path, e)
+        return None
+
+
+def write_json(name: str, data) -> None:
+    """
+    Write a JSON file to the cache directory. The file is replaced atomically
+    so concurrent readers never see a partial write.
+    """
+
+    directory = cache_dir()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, os.path.join(directory, name))
+    except OSError as e:
+        logger.error("Failed to write cache file {}: {}", name, e)
+        os.unlink(tmp_path)
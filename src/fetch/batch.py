@@ -0,0 +1,169 @@
+import asyncio
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+from fetch import fetch
+from loguru import logger
+from parse.parse import id_patterns
+
+
+def parse_identifier(line: str) -> str | None:
+    """
+    Read an identifier from a line of text: a plain identifier, or a line of
+    the 'jsonl' or 'csv' output formats of the parse command. Returns None
+    for blank lines and lines that can't be read.
+    """
+
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith("{"):
+        try:
+            return json.loads(line)["id"]
+        except (ValueError, KeyError, TypeError):
+            logger.error("Couldn't read identifier from line: {}", line)
+            return None
+
+    # 'csv' lines look like "<id>,<type>", or "<id>,<type>,<path>" with
+    # --source, but a plain identifier may contain commas too, so the id only
+    # ends before a field that is a known id type
+    fields = line.split(",")
+    for i, field in enumerate(fields[1:], 1):
+        if field in id_patterns:
+            return ",".join(fields[:i])
+    return line
+
+
+def read_identifiers(lines: Iterable[str]) -> Iterator[str]:
+    "Read identifiers from lines of text (see parse_identifier)"
+
+    for line in lines:
+        identifier = parse_identifier(line)
+        if identifier is not None:
+            yield identifier
+
+
+async def stream_identifiers(f) -> AsyncIterator[str]:
+    """
+    Like read_identifiers, but reads the lines of a file in a thread, so that
+    downloads keep running and results keep coming out while it waits for
+    the next line of a pipe.
+    """
+
+    while line := await asyncio.to_thread(f.readline):
+        identifier = parse_identifier(line)
+        if identifier is not None:
+            yield identifier
+
+
+async def iterate(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+async def fetch_batch(
+    session,
+    identifiers: Iterable[str] | AsyncIterable[str],
+    providers: str,
+    out_dir: str,
+    concurrency: int = 8,
+    store=None,
+    rename: str = "eager",
+    executor=None,
+) -> AsyncIterator[dict]:
+    """
+    Download papers for many identifiers with the given session, running at
+    most `concurrency` downloads at once. Yields a result for each identifier
+    as soon as it completes, in completion order, even while the next
+    identifier is still being read from an async iterable.
+
+    `rename` is one of "eager" (rename each paper to its title before it
+    counts as done), "lazy" (rename papers in the background, so that the
+    next download can start while the PDF is parsed) or "none".
+    """
+
+    async def download(identifier):
+        try:
+            return identifier, await fetch.download_paper(
+                session,
+                identifier,
+                providers,
+                out_dir,
+                store,
+                rename=rename == "eager",
+                executor=executor,
+            )
+        except Exception as e:
+            logger.error("Failed to fetch {}: {}", identifier, e)
+            return identifier, None
+
+    async def rename_later(identifier, path, url):
+        try:
+            new_path = await fetch.rename_paper(
+                identifier, path, url, out_dir, store, executor
+            )
+        except Exception as e:
+            # the paper was downloaded, it just keeps its original name
+            logger.error("Failed to rename {}: {}", identifier, e)
+            new_path = path
+        return identifier, (new_path, url)
+
+    if not hasattr(identifiers, "__aiter__"):
+        identifiers = iterate(identifiers)
+
+    downloads = set()
+    renames = set()
+    # the read of the next identifier, which runs alongside the downloads
+    reading = None
+    exhausted = False
+
+    def collect(done) -> list[dict]:
+        "Returns the results of finished downloads and renames"
+
+        nonlocal downloads, renames
+        downloaded = done & downloads
+        downloads -= done
+        renames -= done
+
+        results = []
+        for task in done:
+            identifier, result = task.result()
+            path, url = result if result else (None, None)
+            # papers from the store already have their final name
+            if (
+                rename == "lazy"
+                and task in downloaded
+                and path is not None
+                and fetch.content_digest(path) is not None
+            ):
+                renames.add(asyncio.create_task(rename_later(identifier, path, url)))
+            else:
+                results.append({"id": identifier, "url": url, "path": path})
+        return results
+
+    try:
+        while not exhausted or downloads or renames:
+            if not exhausted and reading is None and len(downloads) < concurrency:
+                reading = asyncio.ensure_future(anext(identifiers, None))
+
+            waiting = downloads | renames | ({reading} if reading else set())
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if reading in done:
+                done.discard(reading)
+                identifier = reading.result()
+                reading = None
+                if identifier is None:
+                    exhausted = True
+                else:
+                    downloads.add(asyncio.create_task(download(identifier)))
+
+            for result in collect(done):
+                yield result
+    finally:
+        # a batch that's abandoned or fails leaves nothing running
+        for task in downloads | renames:
+            task.cancel()
+        if reading is not None:
+            reading.cancel()
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import aiohttp
+import metrics
+from loguru import logger
+
+PDF_CONTENT_TYPES = ("application/pdf", "application/octet-stream")
+PDF_MAGIC = b"%PDF-"
+# the PDF header has to be within the first 1024 bytes of the file
+PDF_HEADER_LIMIT = 1024
+
+# PDFs are streamed to disk in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# how many times an interrupted download is resumed before giving up
+RESUME_RETRIES = 3
+
+# errors that leave a partial download behind that can be resumed
+DOWNLOAD_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def partial_paths(out_dir: str, key: str) -> tuple[str, str]:
+    """
+    Returns the paths of the partial download and of its journal for the
+    paper identified by key.
+    """
+
+    name = "." + hashlib.sha1(key.encode()).hexdigest()
+    return (
+        os.path.join(out_dir, name + ".part"),
+        os.path.join(out_dir, name + ".part.json"),
+    )
+
+
+def read_journal(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_journal(path: str, journal: dict) -> None:
+    with open(path, "w") as f:
+        json.dump(journal, f)
+
+
+def validators(res) -> dict:
+    "The headers that tell whether a resumed download is still the same file"
+    return {
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+    }
+
+
+def range_start(res) -> int | None:
+    "Returns the first byte of a partial response, e.g. 100 in 'bytes 100-199/200'"
+    try:
+        unit, _, byte_range = res.headers["Content-Range"].partition(" ")
+        return int(byte_range.split("-")[0]) if unit == "bytes" else None
+    except (KeyError, ValueError):
+        return None
+
+
+def hash_file(path: str):
+    "Returns the md5 hash of a file, reading it in chunks"
+    pdf_hash = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            pdf_hash.update(chunk)
+    return pdf_hash
+
+
+async def read_head(res) -> bytes:
+    "Read the start of a response body, where the PDF header should be"
+
+    head = b""
+    while len(head) < PDF_HEADER_LIMIT:
+        chunk = await res.content.read(PDF_HEADER_LIMIT - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+async def write_body(res, f, pdf_hash) -> None:
+    async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+        pdf_hash.update(chunk)
+        f.write(chunk)
+
+
+def finish(part_path: str, journal_path: str, out_dir: str, pdf_hash) -> str:
+    "Move a complete download into place under its hash and drop its journal"
+
+    path = os.path.join(out_dir, f"{pdf_hash.hexdigest()}.pdf")
+    logger.info(f"Saving file to {path}")
+    os.replace(part_path, path)
+    run_metrics = metrics.get_metrics()
+    run_metrics.count("papers_downloaded")
+    run_metrics.count("pdf_bytes", os.path.getsize(path))
+    try:
+        os.unlink(journal_path)
+    except FileNotFoundError:
+        pass
+    return path
+
+
+async def download(session, res, url: str, head: bytes, out_dir: str, key: str):
+    """
+    Stream a PDF response to out_dir, hashing it on the way, and return the
+    path it was saved to. `head` is the part of the body that has already
+    been read.
+
+    The body is written to a .part file next to a journal holding the URL
+    and the validators of the response, and only moved to <md5>.pdf once
+    it's complete. If the download is interrupted, it's resumed with Range
+    requests. The partial file is kept if that fails too, so that a later
+    run can resume it with `resume`.
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    part_path, journal_path = partial_paths(out_dir, key)
+    write_journal(journal_path, {"url": url, **validators(res)})
+
+    pdf_hash = hashlib.md5(head)
+    try:
+        with open(part_path, "wb") as f:
+            f.write(head)
+            await write_body(res, f, pdf_hash)
+    except DOWNLOAD_ERRORS as e:
+        logger.info("Download from {} was interrupted: {}", url, e)
+        metrics.get_metrics().count("download_interruptions")
+        result = await resume(session, out_dir, key)
+        if result is None:
+            raise
+        return result[0]
+
+    return finish(part_path, journal_path, out_dir, pdf_hash)
+
+
+async def resume(session, out_dir: str, key: str) -> tuple | None:
+    """
+    Resume the partial download of the paper identified by key, if there is
+    one. Returns the path the paper was saved to and the URL it was
+    downloaded from, or None if there was nothing to resume or resuming
+    failed.
+    """
+
+    part_path, journal_path = partial_paths(out_dir, key)
+    journal = read_journal(journal_path)
+    if journal is None or not os.path.exists(part_path):
+        return None
+
+    url = journal["url"]
+    run_metrics = metrics.get_metrics()
+    for _ in range(RESUME_RETRIES):
+        offset = os.path.getsize(part_path)
+        headers = {"Range": f"bytes={offset}-"}
+        # the server should send the whole file if it changed since
+        validator = journal.get("etag") or journal.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+
+        logger.info("Resuming download from {} at byte {}", url, offset)
+        run_metrics.count("download_resumes")
+        try:
+            async with session.get(url, headers=headers) as res:
+                if res.status == 206 and range_start(res) == offset:
+                    with run_metrics.span("download.hash"):
+                        pdf_hash = hash_file(part_path)
+                    mode = "ab"
+                elif res.status == 200 and res.content_type in PDF_CONTENT_TYPES:
+                    logger.info("Can't resume download from {}, restarting", url)
+                    journal.update(validators(res))
+                    write_journal(journal_path, journal)
+                    pdf_hash = hashlib.md5()
+                    mode = "wb"
+                else:
+                    logger.info("Can't resume download from {}: {}", url, res.status)
+                    break
+
+                with open(part_path, mode) as f:
+                    await write_body(res, f, pdf_hash)
+        except DOWNLOAD_ERRORS as e:
+            logger.info("Download from {} was interrupted: {}", url, e)
+            continue
+
+        return (finish(part_path, journal_path, out_dir, pdf_hash), url)
+    else:
+        # keep the partial download around for the next run
+        logger.error("Couldn't finish download from {}", url)
+        return None
+
+    os.unlink(part_path)
+    os.unlink(journal_path)
+    return None
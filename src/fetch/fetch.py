@@ -1,118 +1,386 @@
 import asyncio
-import hashlib
 import json
 import os
-from typing import Iterable
+import re
 
-import aiohttp
-import pdf2doi
-import providers.scidb as scidb
-import providers.scihub as scihub
+import fetch.download as download
+import fetch.metadata as metadata
+import fetch.misses as misses
+import metrics
+from fetch.singleflight import SingleFlight
+from fetch.store import link
 import providers.arxiv as arxiv
+import providers.registry as registry
+import providers.scihub as scihub
 from loguru import logger
+from parse.parse import normalize_id
+from providers import ProviderUnavailableError
+from providers.base import Provider
+
+# downloads in flight, shared by every concurrent request for the same
+# paper, for the same PDF URL and for renaming the same file
+paper_flights = SingleFlight()
+url_flights = SingleFlight()
+rename_flights = SingleFlight()
+
+
+async def lookup(session, identifier, provider: Provider) -> list[str]:
+    """
+    Get the URLs a provider has for a paper, unless it's known not to have
+    it. Providers that are reached but don't have the paper are remembered
+    as misses. Errors are logged rather than raised, so that one provider
+    failing doesn't stop the others.
+    """
 
-all_providers = ["scihub", "scidb", "arxiv"]
-
-
-def match_available_providers(
-    providers, available_providers: Iterable[str] | None = None
-) -> list[str]:
-    "Find the providers that are included in available_providers"
-    if not available_providers:
-        available_providers = all_providers
-    matching_providers = []
-    for provider in providers:
-        for available_provider in available_providers:
-            # a user-supplied provider might be a substring of a supported
-            # provider (e.g. sci-hub.ee instead of https://sci-hub.ee)
-            if provider in available_provider:
-                matching_providers.append(available_provider)
-    return matching_providers
-
-
-async def get_urls(session, identifier, providers):
-    urls = []
-    if providers == "all":
-        urls.append(await scidb.get_url(session, identifier))
-        urls.extend(await scihub.get_direct_urls(session, identifier))
-        urls.append(await arxiv.get_url(identifier))
-        return urls
-
-    providers = [provider.strip() for provider in providers.split(",")]
-    logger.info(f"given providers: {providers}")
-
-    matching_providers = match_available_providers(providers)
-    logger.info(f"matching providers: {matching_providers}")
-    for mp in matching_providers:
-        if mp == "scihub":
-            urls.extend(await scihub.get_direct_urls(session, identifier))
-        if mp == "scidb":
-            urls.append(await scidb.get_url(session, identifier))
-        if mp == "arxiv":
-            urls.append(await arxiv.get_url(identifier))
-
-    # if the catch-all "scihub" provider isn't given, we look for
-    # specific Sci-Hub urls. if we find specific Sci-Hub URLs in the
-    # user input, we only use those
-    if "scihub" not in providers:
-        matching_scihub_urls = match_available_providers(
-            providers, await scihub.get_available_scihub_urls()
+    known_misses = misses.get_misses()
+    if provider.cache_misses and known_misses.is_miss(identifier, provider.name):
+        logger.info(
+            "Skipping {}, it didn't have {} recently", provider.name, identifier
         )
-        logger.info(f"matching scihub urls: {matching_scihub_urls}")
-        if len(matching_scihub_urls) > 0:
-            urls.extend(
-                await scihub.get_direct_urls(
-                    session, identifier, base_urls=matching_scihub_urls
-                )
-            )
+        return []
+
+    run_metrics = metrics.get_metrics()
+    try:
+        with run_metrics.span(f"provider.{provider.name}"):
+            async with asyncio.timeout(provider.timeout):
+                urls = await provider.get_urls(session, identifier)
+    except ProviderUnavailableError as e:
+        logger.info("Couldn't reach {}: {}", provider.name, e)
+        return []
+    except TimeoutError:
+        logger.info("{} took too long to find {}", provider.name, identifier)
+        run_metrics.count("provider_timeouts")
+        return []
+    except Exception as e:
+        logger.error("Error while searching {}: {}", provider.name, e)
+        return []
 
+    if provider.cache_misses:
+        if urls:
+            known_misses.record_hit(identifier, provider.name)
+        else:
+            known_misses.record_miss(identifier, provider.name)
     return urls
 
 
-async def fetch(session, identifier, providers) -> tuple | None:
-    # catch exceptions so that they don't cancel the task group
-    async def get_wrapper(url):
+async def get_urls(session, identifier, providers) -> list[str]:
+    """
+    Find links to the PDF of a paper with the given providers ("all", or a
+    comma separated list of names). Every provider searches at the same time,
+    and the links are ordered by provider priority.
+    """
+
+    selected = registry.select_providers(providers)
+    logger.info("searching providers: {}", [provider.name for provider in selected])
+
+    with metrics.get_metrics().span("get_urls"):
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                (provider, tg.create_task(lookup(session, identifier, provider)))
+                for provider in selected
+            ]
+
+    tasks.sort(key=lambda task: -task[0].priority)
+    return [url for _, task in tasks for url in task.result()]
+
+
+def direct_urls(identifier: str, providers) -> list[str]:
+    """
+    Returns the links to a paper's PDF that follow from its identifier alone:
+    the identifier itself if it's a link to a PDF, or arXiv's link for arXiv
+    ids when arXiv is one of the providers. These need no mirror discovery
+    or lookups at all.
+    """
+
+    if scihub.classify(identifier) == scihub.IDClass["URL-DIRECT"]:
+        return [identifier]
+
+    pdf_url = arxiv.pdf_url(identifier)
+    if pdf_url is not None:
+        selected = registry.select_providers(providers)
+        if any(provider.name == arxiv.Arxiv.name for provider in selected):
+            return [pdf_url]
+    return []
+
+
+async def fetch(session, identifier, providers, out_dir=".") -> tuple | None:
+    """
+    Download a paper into out_dir. Returns the path it was saved to and the
+    URL it was downloaded from, or None if no provider had it.
+    """
+
+    run_metrics = metrics.get_metrics()
+
+    # pick up where an interrupted download of this paper left off
+    with run_metrics.span("fetch.resume"):
+        result = await download.resume(session, out_dir, identifier)
+    if result is not None:
+        return result
+
+    # links that follow from the identifier are tried before any provider
+    result = None
+    urls = direct_urls(identifier, providers)
+    if urls:
+        logger.info("Trying direct PDF urls: {}", "\n".join(urls))
+        with run_metrics.span("fetch.direct"):
+            result = await fetch_from(session, identifier, urls, out_dir)
+
+    if result is None:
+        urls = await get_urls(session, identifier, providers)
+
+        if len(urls) > 0:
+            logger.info("PDF urls: {}", "\n".join(urls))
+
+        with run_metrics.span("fetch.provider_urls"):
+            result = await fetch_from(session, identifier, urls, out_dir)
+
+    return result
+
+
+async def fetch_from(session, identifier, urls: list[str], out_dir) -> tuple | None:
+    """
+    Download a paper from whichever of urls answers with a PDF first (see
+    race_pdf). Downloads from the same URL are shared, so if another paper is
+    already coming from one of the urls, that download is waited for instead.
+    """
+
+    for url in urls:
+        if url in url_flights:
+            result = share(await url_flights.join(url), out_dir)
+            if result is not None:
+                return result
+
+    run_metrics = metrics.get_metrics()
+    with run_metrics.span("fetch.race"):
+        result = await race_pdf(session, urls)
+    if result is None:
+        return None
+
+    res, url, head = result
+
+    async def save():
         try:
-            return await session.get(url)
-        except Exception as e:
-            logger.error("error: {}", e)
+            with run_metrics.span("fetch.download"):
+                path = await download.download(
+                    session, res, url, head, out_dir, identifier
+                )
+            return (path, url)
+        except download.DOWNLOAD_ERRORS as e:
+            logger.error("Failed to download {}: {}", url, e)
             return None
+        finally:
+            res.release()
 
-    urls = await get_urls(session, identifier, providers)
+    if url in url_flights:
+        # another paper started downloading from this URL during the race
+        res.close()
+    return share(await url_flights.do(url, save), out_dir)
 
-    urls = [url for url in urls if url is not None]
 
-    if len(urls) > 0:
-        logger.info("PDF urls: {}", "\n".join(urls))
-    tasks = [get_wrapper(url) for url in urls if url]
-    for item in zip(asyncio.as_completed(tasks), urls):
-        res = await item[0]
-        if res is None or res.content_type != "application/pdf":
-            logger.info("couldn't find url at {}", item[1])
-            continue
-        return (await res.read(), item[1])
-    return None
+def share(result: tuple | None, out_dir) -> tuple | None:
+    """
+    Make a paper that may have been fetched for another caller available in
+    out_dir, by linking it there if it was saved somewhere else. Returns its
+    path in out_dir and the URL it was downloaded from.
+    """
+
+    if result is None:
+        return None
 
+    path, url = result
+    if os.path.abspath(os.path.dirname(path)) == os.path.abspath(out_dir):
+        return result
 
-def save(data, path):
+    os.makedirs(out_dir, exist_ok=True)
+    new_path = os.path.join(out_dir, os.path.basename(path))
+    link(path, new_path)
+    return (new_path, url)
+
+
+async def race_pdf(session, urls: list[str]) -> tuple | None:
     """
-    Save a file give data and a path.
+    Request all URLs at once and return the first response that is a PDF,
+    along with its URL and the bytes already read from its body. All other
+    requests are cancelled and their connections closed as soon as a PDF is
+    found. The caller is responsible for releasing the winning response.
     """
+
+    async def get_pdf(url):
+        res = await session.get(url)
+        try:
+            if res.status == 200 and res.content_type in download.PDF_CONTENT_TYPES:
+                head = await download.read_head(res)
+                if download.PDF_MAGIC in head:
+                    return (res, url, head)
+        except BaseException:
+            res.close()
+            raise
+        res.close()
+        return None
+
+    tasks = {asyncio.create_task(get_pdf(url)): url for url in dict.fromkeys(urls)}
+    pending = set(tasks)
+    winner = None
     try:
-        logger.info(f"Saving file to {path}")
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.error("error: {}", e)
+                    result = None
+                if result is None:
+                    logger.info("couldn't find url at {}", tasks[task])
+                elif winner is None:
+                    winner = result
+                else:
+                    # another PDF finished in the same step
+                    result[0].close()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    if winner is not None:
+        logger.info("found PDF at {}", winner[1])
+    return winner
+
+
+async def download_paper(
+    session,
+    identifier,
+    providers,
+    out_dir,
+    store=None,
+    rename=True,
+    executor=None,
+) -> tuple | None:
+    """
+    Fetch a paper, save it to out_dir and rename it to its title. Returns the
+    final path and the URL the paper was downloaded from, or None if no
+    provider had it. If a PaperStore is given, papers already in it are
+    linked from there instead of being downloaded again, and new downloads
+    are added to it.
+
+    Titles are looked up in `executor` (see rename_async). With rename=False
+    the paper keeps its <md5>.pdf name and can be renamed later with
+    rename_paper.
+    """
+
+    async def get_paper():
+        if store is not None:
+            result = store.checkout(identifier, out_dir)
+            if result is not None:
+                return result
+
+        result = await fetch(session, identifier, providers, out_dir)
+        if result is None:
+            return None
+
+        path, url = result
+        if rename:
+            path = await rename_paper(identifier, path, url, out_dir, store, executor)
+        elif store is not None:
+            store.add(identifier, path, content_digest(path), url)
+        return (path, url)
+
+    # concurrent requests for the same paper share one download
+    with metrics.get_metrics().span("paper"):
+        result = await paper_flights.do(normalize_id(identifier), get_paper)
+    return share(result, out_dir)
+
+
+async def rename_paper(
+    identifier, path, url, out_dir, store=None, executor=None
+) -> str:
+    """
+    Rename a freshly downloaded paper to its title without blocking the event
+    loop, and record its new name in the store. Returns the new path.
+    """
+
+    digest = content_digest(path)
+    # papers downloaded from the same URL for different identifiers share a
+    # file, which is renamed once
+    new_path = await rename_flights.do(
+        os.path.abspath(path), lambda: rename_async(out_dir, path, executor)
+    )
+    if store is not None:
+        store.add(identifier, new_path, digest, url)
+    return new_path
+
+
+def content_digest(path) -> str | None:
+    """
+    Downloads are named by the md5 hash of their content until they are
+    renamed. Returns that hash, or None if the file has been renamed.
+    """
+
+    name = os.path.basename(path)
+    if re.fullmatch(r"[0-9a-f]{32}\.pdf", name):
+        return name[:-4]
+    return None
+
+
+def find_title(path) -> str | None:
+    """
+    Find the title of the paper in a PDF. The PDF's metadata and first page
+    are tried first. Only if that fails is the PDF handed to pdf2doi, which
+    is slow and may look the paper up online, so use rename_async to run this
+    off the event loop.
+    """
 
-        with open(path, "wb") as f:
-            f.write(data)
+    logger.info("Finding paper title")
+    run_metrics = metrics.get_metrics()
+    try:
+        with run_metrics.span("rename.metadata"):
+            title = metadata.extract_metadata(path, find_doi=False)["title"]
+        if title:
+            return title
     except Exception as e:
-        logger.error(f"Failed to write to {path} {e}")
-        raise e
+        logger.info("Couldn't read metadata from {}: {}", path, e)
+
+    # pdf2doi pulls in several PDF libraries, so it's only imported when the
+    # fast path didn't find a title
+    import pdf2doi
+
+    pdf2doi.config.set("verbose", False)
+
+    with run_metrics.span("rename.pdf2doi"):
+        result_info = pdf2doi.pdf2doi(path)
+    if not result_info:
+        return None
+    raw_validation_info = result_info["validation_info"]
+    if isinstance(raw_validation_info, (str, bytes, bytearray)):
+        validation_info = json.loads(raw_validation_info)
+    else:
+        validation_info = raw_validation_info
+    if not validation_info:
+        return None
+    return validation_info.get("title")
 
 
-def generate_name(content):
-    "Generate unique filename for paper"
+async def rename_async(out_dir, path, executor=None) -> str:
+    """
+    Like rename, but finds the title in an executor so the event loop keeps
+    running while the PDF is parsed. Pass a ProcessPoolExecutor to parse
+    several PDFs in parallel.
+    """
 
-    pdf_hash = hashlib.md5(content).hexdigest()
-    return f"{pdf_hash}" + ".pdf"
+    loop = asyncio.get_running_loop()
+    try:
+        # in a process pool, the stages of find_title are timed there and
+        # only this span is recorded
+        with metrics.get_metrics().span("rename.title"):
+            name = await loop.run_in_executor(executor, find_title, path)
+    except Exception as e:
+        logger.error(f"Couldn't get paper title from PDF at {path}: {e}")
+        return path
+    if not name:
+        return path
+    return rename(out_dir, path, name)
 
 
 def rename(out_dir, path, name=None) -> str:
@@ -122,20 +390,9 @@ def rename(out_dir, path, name=None) -> str:
     successful, or the original path if not.
     """
 
-    logger.info("Finding paper title")
-    pdf2doi.config.set("verbose", False)
-
     try:
         if name is None:
-            result_info = pdf2doi.pdf2doi(path)
-            if not result_info:
-                return path
-            raw_validation_info = result_info["validation_info"]
-            if isinstance(raw_validation_info, (str, bytes, bytearray)):
-                validation_info = json.loads(raw_validation_info)
-            else:
-                validation_info = raw_validation_info
-            name = validation_info.get("title")
+            name = find_title(path)
 
         if name:
             name += ".pdf"
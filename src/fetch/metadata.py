@@ -0,0 +1,93 @@
+import itertools
+import re
+
+from loguru import logger
+from parse.parse import parse_ids_from_text
+
+# how many pages to read from the start of a PDF
+MAX_PAGES = 2
+
+# titles outside this range are most likely not titles
+MIN_TITLE_LENGTH = 8
+MAX_TITLE_LENGTH = 300
+
+# metadata titles that are left over from the tool that made the PDF
+placeholder_title = re.compile(
+    r"^(untitled|title|microsoft word\b|.*\.(pdf|docx?|tex|dvi|indd)$)",
+    flags=re.IGNORECASE,
+)
+
+
+def clean(text: str) -> str:
+    return " ".join(text.split())
+
+
+def is_title(text: str) -> bool:
+    return (
+        MIN_TITLE_LENGTH <= len(text) <= MAX_TITLE_LENGTH
+        and not placeholder_title.match(text)
+        and not parse_ids_from_text(text, ["doi"])
+    )
+
+
+def largest_text(page) -> str | None:
+    """
+    Returns the text set in the largest font on a page, which on the first
+    page of a paper is usually its title.
+    """
+
+    lines = []
+    for block in page.get_text("dict")["blocks"]:
+        for line in block.get("lines", []):
+            text = clean("".join(span["text"] for span in line["spans"]))
+            if text:
+                size = max(span["size"] for span in line["spans"])
+                lines.append((round(size, 1), text))
+
+    if not lines:
+        return None
+    largest = max(size for size, _ in lines)
+    # titles often wrap over several lines
+    return clean(" ".join(text for size, text in lines if size == largest))
+
+
+def extract_metadata(path: str, find_doi: bool = True) -> dict[str, str | None]:
+    """
+    Finds the DOI and title of the paper in a PDF using only the PDF's
+    metadata and the text of its first pages. This is fast and never goes
+    online, but it's a best guess. Extracting the text of the pages is the
+    slow part, so callers that only need the title can skip the DOI with
+    find_doi=False, and it's left as None.
+    """
+
+    # PyMuPDF is slow to import, and only needed once a PDF is downloaded
+    import fitz
+
+    doi = None
+    title = None
+    with fitz.open(path) as doc:
+        metadata = doc.metadata or {}
+
+        candidate = clean(metadata.get("title") or "")
+        if is_title(candidate):
+            title = candidate
+
+        if find_doi:
+            # pages are only extracted until a DOI turns up
+            texts = itertools.chain(
+                [metadata.get("subject") or "", metadata.get("keywords") or ""],
+                (doc[i].get_text() for i in range(min(MAX_PAGES, len(doc)))),
+            )
+            for text in texts:
+                dois = parse_ids_from_text(text, ["doi"])
+                if dois:
+                    doi = dois[0]["id"]
+                    break
+
+        if title is None and len(doc) > 0:
+            candidate = largest_text(doc[0])
+            if candidate and is_title(candidate):
+                title = candidate
+
+    logger.info("found DOI {} and title {} in {}", doi, title, path)
+    return {"doi": doi, "title": title}
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import time
+
+import cache
+from loguru import logger
+from parse.parse import normalize_id
+
+MISSES_DB_FILE = "misses.sqlite3"
+
+# a provider that didn't have a paper isn't asked for it again for MISS_TTL
+# seconds, and the wait grows by MISS_BACKOFF each time it misses again
+MISS_TTL = 6 * 60 * 60
+MISS_BACKOFF = 4
+MAX_MISS_TTL = 30 * 24 * 60 * 60
+
+
+class MissCache:
+    """
+    Remembers which providers didn't have which papers, across runs, so
+    that known misses are skipped instead of repeating every lookup. Misses
+    are re-checked on a schedule that backs off while they keep missing.
+    Each miss is written to an SQLite database as it's recorded, so a large
+    batch never rewrites the misses it already knows about.
+    """
+
+    def __init__(self, path: str = ":memory:", ttl: float = MISS_TTL):
+        # a TTL of 0 turns the cache off
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        # a commit per miss stays cheap when it doesn't wait for the disk
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS misses (
+                key TEXT PRIMARY KEY,
+                misses INTEGER NOT NULL,
+                until REAL NOT NULL
+            )
+            """)
+        # forget misses that have been due for a re-check for a long time
+        self.db.execute(
+            "DELETE FROM misses WHERE until < ?", (time.time() - MAX_MISS_TTL,)
+        )
+        self.db.commit()
+
+    @classmethod
+    def load(cls) -> "MissCache":
+        return cls(os.path.join(cache.cache_dir(), MISSES_DB_FILE))
+
+    def close(self) -> None:
+        self.db.close()
+
+    @staticmethod
+    def key(identifier: str, provider: str) -> str:
+        return f"{provider} {normalize_id(identifier)}"
+
+    def is_miss(self, identifier: str, provider: str) -> bool:
+        "Returns True while a provider is known not to have a paper"
+        if self.ttl <= 0:
+            return False
+        row = self.db.execute(
+            "SELECT until FROM misses WHERE key = ?", (self.key(identifier, provider),)
+        ).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def record_miss(self, identifier: str, provider: str) -> None:
+        if self.ttl <= 0:
+            return
+        key = self.key(identifier, provider)
+        row = self.db.execute(
+            "SELECT misses FROM misses WHERE key = ?", (key,)
+        ).fetchone()
+        count = row[0] if row is not None else 0
+        ttl = min(self.ttl * MISS_BACKOFF**count, MAX_MISS_TTL)
+        self.db.execute(
+            "INSERT OR REPLACE INTO misses VALUES (?, ?, ?)",
+            (key, count + 1, time.time() + ttl),
+        )
+        self.db.commit()
+        logger.info(
+            "{} doesn't have {}, skipping it for {}s", provider, identifier, ttl
+        )
+
+    def record_hit(self, identifier: str, provider: str) -> None:
+        cursor = self.db.execute(
+            "DELETE FROM misses WHERE key = ?", (self.key(identifier, provider),)
+        )
+        if cursor.rowcount:
+            self.db.commit()
+
+
+# known misses are loaded once and shared by every lookup in a run
+_misses: MissCache | None = None
+
+
+def get_misses() -> MissCache:
+    global _misses
+    if _misses is None:
+        _misses = MissCache.load()
+    return _misses
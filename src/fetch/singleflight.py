@@ -0,0 +1,43 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+from loguru import logger
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight,
+    callers asking for the same key wait for its result instead of making the
+    call again. Once it completes, the next call for the key starts afresh.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.calls
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable]):
+        "Returns the result of call(), or of the call already in flight for key"
+
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.forget(key, task))
+        else:
+            logger.info("Joining the call in flight for {}", key)
+
+        # one caller going away doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def join(self, key: Hashable):
+        "Returns the result of the call in flight for key, which must exist"
+        return await asyncio.shield(self.calls[key])
+
+    def forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # retrieve the exception, since every caller may have gone away
+        if not task.cancelled():
+            task.exception()
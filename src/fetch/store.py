@@ -0,0 +1,125 @@
+import os
+import shutil
+import sqlite3
+import time
+
+import cache
+from loguru import logger
+from parse.parse import normalize_id
+
+
+def link(src: str, dst: str) -> None:
+    """
+    Hard link src to dst, replacing dst if it exists. Falls back to copying
+    when hard links aren't possible (e.g. across file systems).
+    """
+
+    # renaming a link onto another link to the same file does nothing, and
+    # would leave the temporary link behind
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+
+    tmp_path = dst + ".tmp"
+    try:
+        os.link(src, tmp_path)
+    except FileExistsError:
+        os.unlink(tmp_path)
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class PaperStore:
+    """
+    A local, content-addressed store of downloaded papers. Each PDF is kept
+    once as a blob named by its md5 hash, and an index maps normalized
+    identifiers to blobs, so a paper that has been downloaded before can be
+    linked into an output directory without touching the network.
+    """
+
+    def __init__(self, root: str | None = None):
+        if root is None:
+            root = os.path.join(cache.cache_dir(), "store")
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(root, "index.sqlite3"))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS papers (
+                identifier TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                name TEXT NOT NULL,
+                url TEXT,
+                added REAL NOT NULL
+            )
+            """)
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest + ".pdf")
+
+    def get(self, identifier: str) -> tuple | None:
+        """
+        Returns the blob path, file name and source URL of a stored paper, or
+        None if it isn't in the store.
+        """
+
+        row = self.db.execute(
+            "SELECT digest, name, url FROM papers WHERE identifier = ?",
+            (normalize_id(identifier),),
+        ).fetchone()
+        if row is None:
+            return None
+
+        digest, name, url = row
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            logger.info("Blob for {} is missing from the store", identifier)
+            self.db.execute(
+                "DELETE FROM papers WHERE identifier = ?", (normalize_id(identifier),)
+            )
+            self.db.commit()
+            return None
+        return (blob_path, name, url)
+
+    def add(self, identifier: str, path: str, digest: str, url: str) -> None:
+        "Add a downloaded paper with the given md5 digest to the store"
+
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            link(path, blob_path)
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?)",
+            (
+                normalize_id(identifier),
+                digest,
+                os.path.basename(path),
+                url,
+                time.time(),
+            ),
+        )
+        self.db.commit()
+
+    def checkout(self, identifier: str, out_dir: str) -> tuple | None:
+        """
+        Link a stored paper into out_dir under the name it was saved with.
+        Returns the path it was linked to and the URL it was originally
+        downloaded from, or None if it isn't in the store.
+        """
+
+        entry = self.get(identifier)
+        if entry is None:
+            return None
+
+        blob_path, name, url = entry
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, name)
+        link(blob_path, path)
+        logger.info("Found {} in the local store", identifier)
+        return (path, url)
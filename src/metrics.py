@@ -0,0 +1,166 @@
+import asyncio
+import bisect
+import contextlib
+import time
+
+# upper bounds in seconds of the buckets stage timings are counted in
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# spans kept for a trace, so that a long run doesn't grow without bound
+MAX_SPANS = 100_000
+
+# prefix of every metric in the Prometheus output
+PROMETHEUS_PREFIX = "papers_dl"
+
+
+class Metrics:
+    """
+    Times the stages of fetching a paper (spans) and counts the work done
+    (requests, bytes, retries). Nothing is recorded until `enabled` is set,
+    and single spans are only kept for a trace when `tracing` is set too.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.started = time.perf_counter()
+        self.stages: dict[str, dict] = {}
+        self.counters: dict[str, float] = {}
+        self.spans: list[dict] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        "Time the code in a with block as one run of the stage `name`"
+
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, start)
+
+    def record(self, name: str, seconds: float, start: float | None = None) -> None:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {
+                "count": 0,
+                "seconds": 0.0,
+                "max": 0.0,
+                "buckets": [0] * len(BUCKETS),
+            }
+        stage["count"] += 1
+        stage["seconds"] += seconds
+        stage["max"] = max(stage["max"], seconds)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        if bucket < len(BUCKETS):
+            stage["buckets"][bucket] += 1
+
+        if self.tracing and len(self.spans) < MAX_SPANS:
+            start = time.perf_counter() - seconds if start is None else start
+            self.spans.append(
+                {"name": name, "start": start - self.started, "seconds": seconds}
+            )
+
+    def count(self, name: str, value: float = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def trace_config(self):
+        "Returns a TraceConfig that counts a session's requests and connections"
+
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            self.count("requests")
+
+        async def on_request_exception(session, context, params):
+            # requests that lost a race to another mirror are cancelled
+            if isinstance(params.exception, asyncio.CancelledError):
+                self.count("requests_cancelled")
+            else:
+                self.count("request_errors")
+
+        async def on_connection_create_end(session, context, params):
+            self.count("connections")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def summary(self) -> dict:
+        "Returns the totals of every stage and counter"
+
+        return {
+            "seconds": time.perf_counter() - self.started,
+            "stages": {
+                name: {
+                    "count": stage["count"],
+                    "seconds": stage["seconds"],
+                    "mean": stage["seconds"] / stage["count"],
+                    "max": stage["max"],
+                }
+                for name, stage in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def trace(self) -> dict:
+        "Returns the summary along with every span, in the order they ended"
+        return {**self.summary(), "spans": self.spans}
+
+    def format_table(self) -> str:
+        summary = self.summary()
+        lines = [
+            f"{'stage':<24} {'count':>7} {'total s':>9} {'mean s':>9} {'max s':>9}"
+        ]
+        for name, stage in summary["stages"].items():
+            lines.append(
+                f"{name:<24} {stage['count']:>7} {stage['seconds']:>9.3f} "
+                f"{stage['mean']:>9.3f} {stage['max']:>9.3f}"
+            )
+        for name, value in summary["counters"].items():
+            lines.append(f"{name:<24} {value:>7}")
+        lines.append(f"{'total':<24} {'':>7} {summary['seconds']:>9.3f}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        "Returns the stages and counters in the Prometheus text format"
+
+        stage_metric = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [
+            f"# HELP {stage_metric} Time spent in each stage of fetching papers.",
+            f"# TYPE {stage_metric} histogram",
+        ]
+        for name, stage in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stage["buckets"]):
+                cumulative += count
+                lines.append(
+                    f'{stage_metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'{stage_metric}_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}'
+            )
+            lines.append(f'{stage_metric}_sum{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f'{stage_metric}_count{{stage="{name}"}} {stage["count"]}')
+
+        for name, value in sorted(self.counters.items()):
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# metrics are shared by every stage of a run
+_metrics: Metrics | None = None
+
+
+def get_metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
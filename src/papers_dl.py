@@ -1,47 +1,241 @@
 import argparse
 import asyncio
+import contextlib
+import json
 import os
 import sys
+import time
 
-import aiohttp
 from loguru import logger
-from fetch import fetch
-from parse.parse import format_output, id_patterns, parse_file, parse_ids_from_text
+import fetch.misses as misses
+import metrics
+from parse.parse import (
+    format_line,
+    id_patterns,
+    parse_files,
+    parse_stream,
+    scan_file,
+)
 
 
-async def fetch_paper(args) -> str:
+async def fetch_paper(args) -> str | None:
+    # the networking and PDF libraries are slow to import, so they're only
+    # loaded by the commands that need them
+    from concurrent.futures import ProcessPoolExecutor
+
+    from fetch import fetch
+    from fetch.batch import fetch_batch, stream_identifiers
+    from fetch.store import PaperStore
+    from session import create_session
+
     providers = args.providers
-    id = args.query
     out = args.output
 
-    headers = None
-    if args.user_agent is not None:
-        headers = {
-            "User-Agent": args.user_agent,
-        }
+    store = None if args.no_store else PaperStore()
+    misses.get_misses().ttl = args.miss_ttl
+    run_metrics = metrics.get_metrics()
+    run_metrics.enabled = args.profile or bool(args.trace or args.metrics)
+    run_metrics.tracing = args.trace is not None
+    # titles are looked up in other processes, so downloads never wait on PDF
+    # parsing
+    executor = None
+    if args.rename != "none":
+        executor = ProcessPoolExecutor(max_workers=min(args.jobs, os.cpu_count() or 1))
+
+    # a single paper can have requests in flight to several mirrors at once
+    sess = create_session(args.jobs * 4, args.per_host, args.user_agent)
+    try:
+        async with sess:
+            if args.query is not None and args.source is None:
+                result = await fetch.download_paper(
+                    sess,
+                    args.query,
+                    providers,
+                    out,
+                    store,
+                    rename=args.rename != "none",
+                    executor=executor,
+                )
+                if result is None:
+                    return None
+                new_path, url = result
+                return (
+                    f"Successfully downloaded paper from {url}.\n Saved to {new_path}"
+                )
+
+            # batch mode: read identifiers from a file or stdin
+            if args.source is None or args.source == "-":
+                source = contextlib.nullcontext(sys.stdin)
+            else:
+                try:
+                    source = open(args.source)
+                except OSError as e:
+                    print(f"Error: {e}", file=sys.stderr)
+                    return ""
+            with source as f:
+                results = fetch_batch(
+                    sess,
+                    stream_identifiers(f),
+                    providers,
+                    out,
+                    args.jobs,
+                    store,
+                    args.rename,
+                    executor,
+                )
+                found = await print_batch(results)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if store is not None:
+            store.close()
+        report_metrics(args)
+
+    # results have already been printed as JSON lines, which the message
+    # mustn't end up between
+    if not found:
+        print("No papers found", file=sys.stderr)
+    return ""
+
+
+def report_metrics(args) -> None:
+    "Print the --profile table and write the --trace and --metrics files"
+
+    run_metrics = metrics.get_metrics()
+    if args.profile:
+        print(run_metrics.format_table(), file=sys.stderr)
 
-    async with aiohttp.ClientSession(headers=headers) as sess:
-        result = await fetch.fetch(sess, id, providers)
+    if args.trace is not None:
+        with open(args.trace, "w") as f:
+            json.dump(run_metrics.trace(), f)
 
-    if result is None:
-        return None
+    if args.metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(run_metrics.prometheus())
+
+
+async def serve_papers(args) -> str | None:
+    from concurrent.futures import ProcessPoolExecutor
+
+    from fetch.store import PaperStore
+    from serve import PaperService, create_app, serve
+
+    store = None if args.no_store else PaperStore()
+    misses.get_misses().ttl = args.miss_ttl
+    # stage timings and counters are served at /metrics
+    metrics.get_metrics().enabled = True
+    executor = None
+    if not args.no_rename:
+        executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+
+    service = PaperService(
+        args.providers,
+        args.output,
+        store,
+        rename=not args.no_rename,
+        executor=executor,
+        limit=args.limit,
+        per_host=args.per_host,
+        user_agent=args.user_agent,
+    )
+    print(
+        f"Serving on {args.unix or f'http://{args.host}:{args.port}'}",
+        file=sys.stderr,
+        flush=True,
+    )
+    try:
+        await serve(create_app(service), args.host, args.port, args.unix)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if store is not None:
+            store.close()
+    return ""
 
-    pdf_content, url = result
 
-    path = os.path.join(out, fetch.generate_name(pdf_content))
-    fetch.save(pdf_content, path)
-    new_path = fetch.rename(out, path)
-    return f"Successfully downloaded paper from {url}.\n Saved to {new_path}"
+async def print_batch(results) -> int:
+    "Print the result of each download as a JSON line as soon as it completes"
 
+    found = 0
+    total = 0
+    async for result in results:
+        total += 1
+        if result["path"] is not None:
+            found += 1
+        print(json.dumps(result), flush=True)
+    logger.info("Downloaded {} of {} papers", found, total)
+    return found
 
-def parse_ids(args) -> str:
-    output = None
-    if hasattr(args, "path") and args.path:
-        output = parse_file(args.path, args.match)
+
+async def mirrors(args) -> str | None:
+    import providers.scihub as scihub
+
+    if args.action == "list":
+        # listing never goes online, that's what refresh is for
+        urls, updated = scihub.cached_scihub_urls()
+        if not urls:
+            return "No cached Sci-Hub mirrors, run 'papers-dl mirrors refresh'"
+        age = time.time() - (updated or 0)
+        expired = " (expired)" if age >= scihub.MIRRORS_TTL else ""
+        print(f"Mirrors found {format_age(age)} ago{expired}", file=sys.stderr)
+        return "\n".join(urls)
+
+    from session import create_session
+
+    async with create_session() as sess:
+        urls = await scihub.get_available_scihub_urls(sess, refresh=True)
+    if not urls:
+        return "No Sci-Hub mirrors found"
+    return "\n".join(urls)
+
+
+def format_age(seconds: float) -> str:
+    "Formats a number of seconds as days, hours and minutes, e.g. '1d 2h 3m'"
+
+    minutes = max(int(seconds), 0) // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    parts = [f"{n}{unit}" for n, unit in ((days, "d"), (hours, "h")) if n]
+    return " ".join([*parts, f"{minutes}m"])
+
+
+def parse_ids(args) -> str | None:
+    paths = args.path or []
+    if len(paths) == 1 and os.path.isfile(paths[0]) and not args.source:
+        try:
+            matches = scan_file(paths[0], args.match, args.mmap)
+            found = print_ids(matches, args.format)
+        except Exception as e:
+            print(f"Error: {e}")
+            return None
+    elif paths:
+        matches = parse_files(paths, args.match, args.jobs, args.mmap)
+        if not args.source:
+            matches = ({"id": m["id"], "type": m["type"]} for m in matches)
+        found = print_ids(matches, args.format)
     else:
         # if a path isn't passed or is empty, read from stdin
-        output = parse_ids_from_text(sys.stdin.read(), args.match)
-    return format_output(output, args.format)
+        found = print_ids(parse_stream(sys.stdin, args.match), args.format)
+
+    # ids have already been printed as they were found
+    return "" if found else None
+
+
+def print_ids(matches, format) -> int:
+    "Print each id as soon as it's found, so parse can feed a pipeline"
+
+    found = 0
+    for match in matches:
+        found += 1
+        print(format_line(match, format), flush=True)
+    return found
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not at least 1")
+    return number
 
 
 async def run():
@@ -70,9 +264,38 @@ async def run():
 
     parser_fetch.add_argument(
         "query",
-        metavar="(DOI|PMID|URL)",
+        metavar="(DOI|PMID|arXiv|URL)",
+        type=str,
+        nargs="?",
+        help="the identifier to try to download. If omitted, identifiers are "
+        "read from stdin",
+    )
+
+    parser_fetch.add_argument(
+        "--from",
+        dest="source",
+        metavar="path",
+        help="download every identifier in a file ('-' for stdin). Accepts "
+        "the output of the parse command",
+        default=None,
         type=str,
-        help="the identifier to try to download",
+    )
+
+    parser_fetch.add_argument(
+        "-j",
+        "--jobs",
+        metavar="n",
+        help="the maximum number of papers to download at once",
+        default=8,
+        type=positive_int,
+    )
+
+    parser_fetch.add_argument(
+        "--per-host",
+        metavar="n",
+        help="the maximum number of connections to a single host",
+        default=4,
+        type=int,
     )
 
     parser_fetch.add_argument(
@@ -92,10 +315,66 @@ async def run():
         type=str,
     )
 
+    parser_fetch.add_argument(
+        "--no-store",
+        help="always download papers, even if they're in the local store",
+        action="store_true",
+    )
+
+    parser_fetch.add_argument(
+        "--rename",
+        help="when to rename papers to their titles: 'eager' before reporting "
+        "them, 'lazy' in the background while the next papers download, or "
+        "'none' to keep them named by their hash",
+        choices=["eager", "lazy", "none"],
+        default="eager",
+    )
+
+    parser_fetch.add_argument(
+        "--no-rename",
+        help="keep papers named by their hash (same as --rename=none)",
+        dest="rename",
+        action="store_const",
+        const="none",
+    )
+
+    parser_fetch.add_argument(
+        "--miss-ttl",
+        metavar="seconds",
+        help="how long to skip a provider after it didn't have a paper. The "
+        "wait grows each time it misses again; 0 always asks every provider",
+        default=misses.MISS_TTL,
+        type=float,
+    )
+
     parser_fetch.add_argument(
         "-A",
         "--user-agent",
-        help="",
+        help="the User-Agent header to send, instead of a common browser's",
+        default=None,
+        type=str,
+    )
+
+    parser_fetch.add_argument(
+        "--profile",
+        help="time each stage of fetching and print a summary to stderr when "
+        "done, along with the number of requests, bytes and retries",
+        action="store_true",
+    )
+
+    parser_fetch.add_argument(
+        "--trace",
+        metavar="path",
+        help="write the summary and every timed span to a JSON file when done",
+        default=None,
+        type=str,
+    )
+
+    parser_fetch.add_argument(
+        "--metrics",
+        metavar="path",
+        help="write the stage timings and the request, byte and retry "
+        "counts to a file in the Prometheus text format when done",
         default=None,
         type=str,
     )
@@ -116,8 +395,32 @@ async def run():
     parser_parse.add_argument(
         "-p",
         "--path",
-        help="the path of the file to parse",
+        help="the files or directories to parse, including PDFs. Glob "
+        "patterns are expanded and directories are searched recursively",
         type=str,
+        nargs="+",
+    )
+    parser_parse.add_argument(
+        "-j",
+        "--jobs",
+        metavar="n",
+        help="the number of processes to parse files with (defaults to the "
+        "number of CPUs)",
+        default=None,
+        type=positive_int,
+    )
+    parser_parse.add_argument(
+        "--mmap",
+        help="scan the raw bytes of files through a memory map instead of "
+        "decoding them, which is faster for large files and ignores encoding "
+        "errors",
+        action="store_true",
+    )
+    parser_parse.add_argument(
+        "--source",
+        help="include the file each id was found in with the 'jsonl' and "
+        "'csv' formats",
+        action="store_true",
     )
     parser_parse.add_argument(
         "-f",
@@ -129,8 +432,102 @@ async def run():
         nargs="?",
     )
 
+    # MIRRORS
+    parser_mirrors = subparsers.add_parser(
+        "mirrors", help="list or refresh the cached Sci-Hub mirrors"
+    )
+    parser_mirrors.add_argument(
+        "action",
+        help="'list' prints the cached mirrors and their age without going "
+        "online, 'refresh' rediscovers them",
+        choices=["list", "refresh"],
+        nargs="?",
+        default="list",
+    )
+
+    # SERVE
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="run a local HTTP service that fetches papers and parses "
+        "identifiers, keeping connections and caches warm between requests",
+    )
+    parser_serve.add_argument(
+        "--host",
+        help="the address to listen on",
+        default="127.0.0.1",
+        type=str,
+    )
+    parser_serve.add_argument(
+        "--port",
+        help="the port to listen on",
+        default=8080,
+        type=int,
+    )
+    parser_serve.add_argument(
+        "--unix",
+        metavar="path",
+        help="listen on a Unix socket at path instead of a TCP port",
+        default=None,
+        type=str,
+    )
+    parser_serve.add_argument(
+        "-o",
+        "--output",
+        metavar="path",
+        help="the directory to save downloaded papers to",
+        default=".",
+        type=str,
+    )
+    parser_serve.add_argument(
+        "-p",
+        "--providers",
+        help="comma separated list of providers to try fetching from",
+        default="all",
+        type=str,
+    )
+    parser_serve.add_argument(
+        "--limit",
+        metavar="n",
+        help="the maximum number of connections open at once",
+        default=32,
+        type=int,
+    )
+    parser_serve.add_argument(
+        "--per-host",
+        metavar="n",
+        help="the maximum number of connections to a single host",
+        default=4,
+        type=int,
+    )
+    parser_serve.add_argument(
+        "--no-store",
+        help="always download papers, even if they're in the local store",
+        action="store_true",
+    )
+    parser_serve.add_argument(
+        "--no-rename",
+        help="keep papers named by their hash",
+        action="store_true",
+    )
+    parser_serve.add_argument(
+        "--miss-ttl",
+        metavar="seconds",
+        help="how long to skip a provider after it didn't have a paper",
+        default=misses.MISS_TTL,
+        type=float,
+    )
+    parser_serve.add_argument(
+        "-A",
+        "--user-agent",
+        help="the User-Agent header to send, instead of a common browser's",
+        default=None,
+        type=str,
+    )
+
     parser_fetch.set_defaults(func=fetch_paper)
     parser_parse.set_defaults(func=parse_ids)
+    parser_mirrors.set_defaults(func=mirrors)
+    parser_serve.set_defaults(func=serve_papers)
 
     args = parser.parse_args()
 
@@ -146,18 +543,27 @@ async def run():
         else:
             result = args.func(args)
 
-        if result:
-            print(result)
-        else:
+        if result is None:
             # TODO: change this to be more general
             print("No papers found")
+        elif result:
+            print(result)
     else:
         parser.print_help()
 
 
 def main():
-    asyncio.run(run())
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        # e.g. stopping `papers-dl serve`
+        sys.exit(130)
+    except BrokenPipeError:
+        # whatever reads our output stopped early (e.g. `papers-dl parse | head`)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    asyncio.run(run())
+    main()
@@ -1,21 +1,29 @@
+import codecs
+import functools
+import glob
+import importlib.util
+import itertools
 import json
+import mmap
+import os
 import re
+from typing import Iterable, Iterator, TextIO
 
-from bs4 import BeautifulSoup
 from loguru import logger
 
+isbn_regex = re.compile(
+    r"^(?:ISBN(?:-1[03])?:? )?(?=[0-9X]{10}$|(?=(?:[0-9]+[- ]){3})[- 0-9X]{13}$|97[89][0-9]{10}$|(?=(?:[0-9]+[- ]){4})[- 0-9]{17}$)(?:97[89][- ]?)?[0-9]{1,5}[- ]?[0-9]+[- ]?[0-9]+[- ]?[0-9X]$"
+)
+isbn_separators = re.compile(r"[- ]|^ISBN(?:-1[03])?:?")
+
 
 # from https://isbn-checker.netlify.app
 def valid_isbn(subject):
     "Check if the subject is a valid ISBN"
 
-    isbn_regex = re.compile(
-        r"^(?:ISBN(?:-1[03])?:? )?(?=[0-9X]{10}$|(?=(?:[0-9]+[- ]){3})[- 0-9X]{13}$|97[89][0-9]{10}$|(?=(?:[0-9]+[- ]){4})[- 0-9]{17}$)(?:97[89][- ]?)?[0-9]{1,5}[- ]?[0-9]+[- ]?[0-9]+[- ]?[0-9X]$"
-    )
-
     # Check if the subject matches the ISBN pattern
     if isbn_regex.match(subject):
-        chars = re.sub(r"[- ]|^ISBN(?:-1[03])?:?", "", subject)
+        chars = isbn_separators.sub("", subject)
         chars = list(chars)
         last = chars.pop()
         sum = 0
@@ -71,6 +79,27 @@ id_patterns = {
     ],
 }
 
+# what matches of a pattern start with, checked before the pattern itself so
+# that a scan skips most positions cheaply. Patterns that start with a
+# literal, like the DOI and arXiv ones, don't need this, since the regex
+# engine already searches for their prefix quickly, and putting anything in
+# front of them would stop it from doing so. These have to be kept in sync
+# with id_patterns.
+id_pattern_guards = {
+    id_patterns["isbn"][0]: "ISBN|[0-9]",
+    id_patterns["isbn"][1]: "ISBN|97[89]",
+}
+
+# the PDF header has to be within the first 1024 bytes of the file
+PDF_HEADER_LIMIT = 1024
+
+# streams are read in chunks of this many characters
+CHUNK_SIZE = 1 << 20
+
+# identifiers are assumed to be at most this long when they are split across
+# the edge of a chunk
+MAX_ID_LENGTH = 1024
+
 # these can eliminate false positives
 # TODO: remove duplication of validation logic and parsing logic
 id_validators = {
@@ -78,24 +107,81 @@ id_validators = {
 }
 
 
+# lxml builds trees several times faster than the parser in the standard
+# library, so it's used when it's installed
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# a dynamically loaded PDF
+pdfobject_regex = re.compile(r'PDFObject\.embed\("([^"]+)"')
+
+# comments, which are skipped, and scripts, whose text isn't markup. Either
+# runs to the end of a page that's cut off inside it.
+comment_or_script_regex = re.compile(
+    r"<!--.*?(?:-->|$)"
+    r"|<script\b(?:[^>\"']|\"[^\"]*\"|'[^']*')*>(.*?)(?:</script\s*>|$)",
+    flags=re.IGNORECASE | re.DOTALL,
+)
+
+# the opening tags of elements that can embed a PDF. Quoted attribute values
+# may contain ">".
+pdf_tag_regex = re.compile(
+    r"""<(?:embed|iframe)\b(?:[^>"']|"[^"]*"|'[^']*')*>""", flags=re.IGNORECASE
+)
+
+
+def split_scripts(html_content: str) -> tuple[list[str], str]:
+    """
+    Returns the text of each script on a page, and the rest of the page
+    without its scripts and comments.
+    """
+
+    scripts = []
+    markup = []
+    end = 0
+    for match in comment_or_script_regex.finditer(html_content):
+        markup.append(html_content[end : match.start()])
+        if match.group(1) is not None:
+            scripts.append(match.group(1))
+        end = match.end()
+    markup.append(html_content[end:])
+    return scripts, "".join(markup)
+
+
 def find_pdf_url(html_content) -> str | None:
-    "Given HTML content, find an embedded link to a PDF."
+    """
+    Given HTML content, find an embedded link to a PDF.
 
-    s = BeautifulSoup(html_content, "html.parser")
+    Pages are scanned for the markers of a PDFObject script and of <embed>
+    and <iframe> tags first, and only the tags that are found are parsed,
+    so most of a page is never turned into a tree. Markers in comments, and
+    tags in the text of scripts, don't count.
+    """
 
-    # look for a dynamically loaded PDF
-    script_element = s.find("script", string=re.compile("PDFObject.embed"))
+    if isinstance(html_content, bytes):
+        html_content = html_content.decode(errors="replace")
+
+    scripts, markup = split_scripts(html_content)
 
-    if script_element:
-        match = re.search(r'PDFObject\.embed\("([^"]+)"', script_element.string)
+    # look for a dynamically loaded PDF
+    for script in scripts:
+        match = pdfobject_regex.search(script)
         if match:
             return match.group(1)
 
+    tags = pdf_tag_regex.findall(markup)
+    if not tags:
+        return None
+
+    # BeautifulSoup is slow to import, and most pages never get this far
+    from bs4 import BeautifulSoup
+
+    s = BeautifulSoup("".join(tags), HTML_PARSER)
+
     # look for the "<embed>" element (scihub)
     embed_element = s.find("embed", {"id": "pdf", "type": "application/pdf"})
 
     if embed_element:
-        direct_url = embed_element["src"]
+        direct_url = embed_element.get("src")
         if isinstance(direct_url, list):
             direct_url = direct_url[0]
         if direct_url:
@@ -115,6 +201,111 @@ def find_pdf_url(html_content) -> str | None:
     return None
 
 
+# the longest marker that's looked for in a page as it arrives, so a marker
+# split between two chunks is still found
+MAX_MARKER_LENGTH = len("PDFObject.embed")
+
+pdf_marker_regex = re.compile(r"PDFObject\.embed", re.IGNORECASE)
+page_end_regex = re.compile(r"</html", re.IGNORECASE)
+
+
+class PDFLinkFinder:
+    """
+    Finds an embedded link to a PDF in HTML that arrives in chunks, so that
+    reading a page can stop as soon as the link is known. A PDFObject script
+    comes first in find_pdf_url, so its link is returned as soon as it's
+    seen. Any other link could still be outranked by a script further down,
+    so it's only returned once the end of the page has arrived.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.text = ""
+        self.marked = False
+        self.ended = False
+
+    def feed(self, chunk: bytes) -> str | None:
+        "Add the next chunk of the page. Returns the PDF link once it's known."
+
+        start = max(len(self.text) - MAX_MARKER_LENGTH, 0)
+        self.text += self.decoder.decode(chunk)
+        if not self.marked:
+            self.marked = pdf_marker_regex.search(self.text, start) is not None
+        if not self.ended:
+            self.ended = page_end_regex.search(self.text, start) is not None
+
+        if self.ended:
+            return find_pdf_url(self.text)
+        if self.marked:
+            scripts, _ = split_scripts(self.text)
+            for script in scripts:
+                match = pdfobject_regex.search(script)
+                if match:
+                    return match.group(1)
+        return None
+
+    def close(self) -> str | None:
+        """
+        Finish the page, or as much of it as was read. Returns the PDF link,
+        or None if there isn't one.
+        """
+
+        self.text += self.decoder.decode(b"", final=True)
+        return find_pdf_url(self.text)
+
+
+@functools.lru_cache
+def compile_patterns(binary: bool = False) -> dict[str, list[re.Pattern]]:
+    """
+    Compiles each pattern once, behind its guard if it has one. With
+    binary=True, the patterns scan bytes instead of strings.
+    """
+
+    patterns = {}
+    for id_type, regexes in id_patterns.items():
+        patterns[id_type] = []
+        for regex in regexes:
+            guard = id_pattern_guards.get(regex)
+            pattern = f"(?={guard})(?:{regex})" if guard else regex
+            patterns[id_type].append(
+                re.compile(pattern.encode() if binary else pattern, re.IGNORECASE)
+            )
+    return patterns
+
+
+def scan_ids(s, id_types: list[str]) -> Iterator[tuple[str, re.Match]]:
+    """
+    Yields the type and match of every match of the given id types' patterns
+    in a string, or in any bytes-like object such as an mmap. Each pattern
+    searches the whole text on its own, in the order of id_types and
+    id_patterns, so identifiers overlapping a match of another pattern (e.g.
+    an ISBN inside a DOI) are found too.
+    """
+
+    patterns = compile_patterns(not isinstance(s, str))
+    for id_type in id_types:
+        for pattern in patterns[id_type]:
+            for match in pattern.finditer(s):
+                yield id_type, match
+
+
+def filter_ids(
+    found: Iterable[tuple[str, str]], seen: set[str]
+) -> Iterator[dict[str, str]]:
+    """
+    Drops ids that are in `seen` or fail validation from (id, type) pairs,
+    adding new ids to `seen`.
+    """
+
+    for mg, id_type in found:
+        if mg in seen:
+            continue
+        seen.add(mg)
+        validator = id_validators.get(id_type)
+        if validator is None or validator(mg):
+            yield {"id": mg, "type": id_type}
+
+
 def parse_ids_from_text(
     s: str, id_types: list[str] | None = None
 ) -> list[dict[str, str]]:
@@ -124,21 +315,150 @@ def parse_ids_from_text(
     """
 
     # we look for all ID patterns by default
+    if id_types is None:
+        id_types = list(id_patterns)
+
+    found = ((match.group(), id_type) for id_type, match in scan_ids(s, id_types))
+    return list(filter_ids(found, set()))
+
+
+def parse_stream(
+    f: TextIO, id_types: list[str] | None = None, chunk_size: int = CHUNK_SIZE
+) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in a text stream, reading it in
+    chunks and yielding each id as soon as it's found, so memory use stays
+    flat however large the input is. If id_types isn't given, defaults to
+    the types in id_patterns.
+    """
+
+    return parse_chunks(read_chunks(f, chunk_size), id_types)
+
+
+def read_chunks(f: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """
+    Read a text stream in chunks of at most chunk_size characters. Streams
+    backed by a binary buffer, like stdin, are read through the buffer, so
+    that each chunk holds whatever is available instead of waiting for a
+    full chunk to arrive.
+    """
+
+    buffer = getattr(f, "buffer", None)
+    if not hasattr(buffer, "read1"):
+        yield from iter(lambda: f.read(chunk_size), "")
+        return
+
+    decoder = codecs.getincrementaldecoder(f.encoding or "utf-8")(
+        errors=f.errors or "strict"
+    )
+    while data := buffer.read1(chunk_size):
+        if text := decoder.decode(data):
+            yield text
+    if text := decoder.decode(b"", final=True):
+        yield text
+
+
+def parse_chunks(
+    chunks: Iterable[str], id_types: list[str] | None = None
+) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in a text that comes in chunks,
+    yielding each id as soon as it's found. Ids split across chunks are
+    found too. If id_types isn't given, defaults to the types in id_patterns.
+    """
+
     if id_types is None:
         id_types = list(id_patterns)
 
     seen = set()
-    matches = []
-    for id_type in id_types:
-        validator = id_validators.get(id_type)
-        for regex in id_patterns[id_type]:
-            for match in re.finditer(regex, s, re.IGNORECASE):
-                mg = match.group()
-                valid_id = validator(mg) if validator else True
-                if mg not in seen and valid_id:
-                    matches.append({"id": mg, "type": id_type})
-                seen.add(mg)
-    return matches
+    carry = ""
+    # an empty chunk marks the end of the input
+    for chunk in itertools.chain((chunk for chunk in chunks if chunk), [""]):
+        text = carry + chunk
+
+        # a match near the end of the text might continue in the next chunk,
+        # so it's scanned again with the next chunk, unless the input ended.
+        # No id pattern matches a line break, so matches on finished lines
+        # are yielded right away, as they are when reading from a pipe.
+        if chunk:
+            limit = max(len(text) - MAX_ID_LENGTH, text.rfind("\n") + 1)
+        else:
+            limit = len(text)
+        cut = max(limit, 0)
+        found = []
+        for id_type, match in scan_ids(text, id_types):
+            if match.end() > limit:
+                # ids longer than MAX_ID_LENGTH may be cut in two. Ids past
+                # the cut are found again in the next chunk, and dropped as
+                # duplicates then.
+                cut = min(cut, max(match.start(), limit - MAX_ID_LENGTH, 0))
+                continue
+            found.append((match.group(), id_type))
+        yield from filter_ids(found, seen)
+
+        carry = text[cut:]
+
+
+# prefixes DOIs are commonly written with
+doi_prefixes = (
+    "https://doi.org/",
+    "http://doi.org/",
+    "https://dx.doi.org/",
+    "http://dx.doi.org/",
+    "doi:",
+)
+
+
+# new-style arXiv ids are also written without the "arXiv:" prefix, but
+# that's only recognised in identifiers, since in running text they look
+# like any other number
+bare_arxiv_regex = re.compile(r"\d{4}\.\d{4,5}(?:v\d+)?")
+
+
+def classify_id(identifier: str) -> str | None:
+    """
+    Returns the type of a single identifier (one of the types in
+    id_patterns), or None if it isn't an identifier of a known type. DOIs
+    may be written as doi.org URLs, and new-style arXiv ids without their
+    'arXiv:' prefix.
+    """
+
+    id = identifier.strip()
+    if id.lower().startswith(doi_prefixes):
+        return "doi"
+    if bare_arxiv_regex.fullmatch(id):
+        return "arxiv"
+
+    # the identifier has to be a single id of a known type
+    for match in parse_ids_from_text(id):
+        if match["id"] == id:
+            return match["type"]
+    return None
+
+
+def normalize_id(identifier: str) -> str:
+    """
+    Returns a canonical form of an identifier, so that different ways of
+    writing the same paper's identifier compare equal. DOIs are case
+    insensitive and may be written as doi.org URLs, arXiv ids may be written
+    with any capitalization of the 'arXiv:' prefix or without it and ISBNs
+    with or without separators. Identifiers of unknown types are returned
+    stripped.
+    """
+
+    id = identifier.strip()
+    lowered = id.lower()
+    id_type = classify_id(id)
+    if id_type == "doi":
+        for prefix in doi_prefixes:
+            lowered = lowered.removeprefix(prefix)
+        return "doi:" + lowered
+    if id_type == "arxiv":
+        return "arxiv:" + lowered.removeprefix("arxiv:")
+    if id_type == "isbn":
+        digits = re.sub(r"^ISBN(?:-1[03])?:?", "", id.upper())
+        return "isbn:" + re.sub(r"[^0-9X]", "", digits)
+    return id
 
 
 def parse_file(path, id_types: list[str] | None = None):
@@ -150,28 +470,172 @@ def parse_file(path, id_types: list[str] | None = None):
     matches = []
     try:
         with open(path) as f:
-            content = f.read()
-        matches = parse_ids_from_text(content, id_types)
+            matches = list(parse_stream(f, id_types))
     except Exception as e:
         print(f"Error: {e}")
 
     return matches
 
 
+def parse_mmap(path, id_types: list[str] | None = None) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in a file by scanning its raw
+    bytes through a memory map. Only the matches are decoded, so the file is
+    never copied into memory and encoding errors can't stop the scan. If
+    id_types isn't given, defaults to the types in id_patterns.
+    """
+
+    if id_types is None:
+        id_types = list(id_patterns)
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        # the map outlives the file, and is unmapped once the last match
+        # pointing into it is gone
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+    found = (
+        (match.group().decode(errors="replace"), id_type)
+        for id_type, match in scan_ids(mapped, id_types)
+    )
+    yield from filter_ids(found, set())
+
+
+def expand_paths(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Yields the files to parse given paths to files or directories, or glob
+    patterns. Directories are searched recursively.
+    """
+
+    for path in paths:
+        if any(c in path for c in "*?["):
+            matches = glob.glob(path, recursive=True)
+        else:
+            matches = [path]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    for file in sorted(files):
+                        yield os.path.join(root, file)
+            else:
+                yield match
+
+
+def is_pdf(path) -> bool:
+    "Check whether a file is a PDF by looking for the PDF header"
+    with open(path, "rb") as f:
+        return b"%PDF-" in f.read(PDF_HEADER_LIMIT)
+
+
+def parse_pdf(path, id_types: list[str] | None = None) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in the text of a PDF. Pages are
+    extracted and scanned one at a time, so the whole document is never
+    rendered or held in memory at once. If id_types isn't given, defaults to
+    the types in id_patterns.
+    """
+
+    # PyMuPDF is slow to import, and only needed for PDFs
+    import fitz
+
+    with fitz.open(path) as doc:
+        yield from parse_chunks((page.get_text() for page in doc), id_types)
+
+
+def scan_file(
+    path, id_types: list[str] | None = None, use_mmap: bool = False
+) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in a file. PDFs are parsed page
+    by page, and other files are read as text, or scanned as raw bytes
+    through a memory map if use_mmap is set.
+    """
+
+    if is_pdf(path):
+        return parse_pdf(path, id_types)
+    if use_mmap:
+        return parse_mmap(path, id_types)
+
+    def read_text():
+        with open(path) as f:
+            yield from parse_stream(f, id_types)
+
+    return read_text()
+
+
+def parse_path(
+    path, id_types: list[str] | None = None, use_mmap: bool = False
+) -> tuple:
+    """
+    Find all matches for the given id types in a file (see scan_file).
+    Returns the matches, and the error that stopped parsing or None. Meant to
+    be run in worker processes by parse_files.
+    """
+
+    try:
+        return (list(scan_file(path, id_types, use_mmap)), None)
+    except Exception as e:
+        return ([], str(e))
+
+
+def parse_files(
+    paths: Iterable[str],
+    id_types: list[str] | None = None,
+    workers: int | None = None,
+    use_mmap: bool = False,
+) -> Iterator[dict[str, str]]:
+    """
+    Find all matches for the given id types in many files, parsing them in
+    parallel in a pool of `workers` processes (one per CPU by default). Ids
+    are deduplicated across files, and each one is tagged with the file it
+    was first found in under "source".
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = list(expand_paths(paths))
+    seen = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = executor.map(
+            parse_path,
+            files,
+            itertools.repeat(id_types),
+            itertools.repeat(use_mmap),
+            chunksize=16,
+        )
+        for path, (matches, error) in zip(files, parsed):
+            if error is not None:
+                logger.error("Error parsing {}: {}", path, error)
+            for match in matches:
+                if match["id"] not in seen:
+                    seen.add(match["id"])
+                    yield {**match, "source": path}
+
+
 def format_output(output: list[dict[str, str]], format: str = "raw") -> str:
     """
     Formats a list of dicts of ids and id types into a string according to the
     given format type. 'raw' formats ids by line, ignoring type. 'jsonl' and
-    'csv' formats ids and types.
+    'csv' formats ids and types, and the source file if there is one.
     """
 
-    lines: list[str] = []
+    return "\n".join(format_line(line, format) for line in output)
+
+
+def format_line(line: dict[str, str], format: str = "raw") -> str:
+    "Formats a single id and id type according to the given format type."
+
     if format == "raw":
-        lines = [line["id"] for line in output]
+        return line["id"]
     elif format == "jsonl":
-        lines = [json.dumps(line) for line in output]
+        return json.dumps(line)
+    elif format == "csv" and "source" in line:
+        return f"{line['id']},{line['type']},{line['source']}"
     elif format == "csv":
-        lines = [f"{line['id']},{line['type']}" for line in output]
+        return f"{line['id']},{line['type']}"
     else:
         raise Exception(f"invalid format {format}")
-    return "\n".join(lines)
@@ -4,3 +4,7 @@ import os
 sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "fetch"))
 )
+
+
+class ProviderUnavailableError(Exception):
+    "Raised when a provider couldn't be reached, so it's unknown whether it has a paper"
@@ -1,13 +1,40 @@
-# from urllib.parse import urljoin
+import re
 
-# from loguru import logger
-from parse.parse import parse_ids_from_text
+from parse.parse import classify_id, normalize_id
+from providers.base import Provider
+
+ARXIV_PDF_URL = "https://arxiv.org/pdf/{}.pdf"
+
+
+def pdf_url(identifier: str) -> str | None:
+    """
+    Returns the link to the PDF of an arXiv paper, or None if the identifier
+    isn't an arXiv id. No request is needed, since arXiv's links follow from
+    the id.
+    """
+
+    if classify_id(identifier) != "arxiv":
+        return None
+    id = normalize_id(identifier).removeprefix("arxiv:")
+    # old-style ids can name a subject class that isn't part of the link,
+    # e.g. math.GT/0309136
+    id = re.sub(r"\.[a-z]{2}/", "/", id)
+    return ARXIV_PDF_URL.format(id)
 
 
 async def get_url(identifier):
-    is_arxiv = parse_ids_from_text(identifier, ["arxiv"])
-    if is_arxiv:
-        pdf_url = f"https://arxiv.org/pdf/{identifier}.pdf"
-        return pdf_url
+    return pdf_url(identifier)
+
+
+class Arxiv(Provider):
+    "arXiv, whose PDF links follow from the identifier alone"
+
+    name = "arxiv"
+    # arXiv's links are known to work, so they go first
+    priority = 1
+    timeout = 5
+    cache_misses = False
 
-    return None
+    async def get_urls(self, session, identifier: str) -> list[str]:
+        pdf_url = await get_url(identifier)
+        return [pdf_url] if pdf_url is not None else []
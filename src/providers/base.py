@@ -0,0 +1,53 @@
+import abc
+from typing import Iterable
+
+
+def match_available_providers(
+    providers: Iterable[str], available_providers: Iterable[str]
+) -> list[str]:
+    "Find the providers that are included in available_providers"
+    matching_providers = []
+    for provider in providers:
+        for available_provider in available_providers:
+            # a user-supplied provider might be a substring of a supported
+            # provider (e.g. sci-hub.ee instead of https://sci-hub.ee)
+            if provider in available_provider:
+                matching_providers.append(available_provider)
+    return matching_providers
+
+
+class Provider(abc.ABC):
+    """
+    A source of links to PDFs. Providers are looked up in the registry (see
+    providers.registry), and every selected provider resolves an identifier
+    at the same time as the others.
+    """
+
+    # the name the provider is picked by with -p, and its misses are
+    # remembered under
+    name: str
+
+    # links from providers with a higher priority are tried first
+    priority: int = 0
+
+    # seconds the provider is given to find links before it's given up on
+    timeout: float = 30
+
+    # providers that never touch the network don't need their misses cached
+    cache_misses: bool = True
+
+    def select(self, names: list[str]) -> "Provider | None":
+        """
+        Returns the provider to use when the user asks for `names` with -p,
+        or None if they didn't ask for this one.
+        """
+
+        return self if match_available_providers(names, [self.name]) else None
+
+    @abc.abstractmethod
+    async def get_urls(self, session, identifier: str) -> list[str]:
+        """
+        Returns links to the PDF of a paper, or an empty list if the provider
+        doesn't have it. Raises ProviderUnavailableError if the provider
+        couldn't be reached.
+        """
@@ -0,0 +1,123 @@
+import time
+from urllib.parse import urlsplit
+
+import cache
+from loguru import logger
+
+HEALTH_CACHE_FILE = "mirror_health.json"
+
+# a mirror's circuit opens after this many failures in a row, and stays open
+# for BREAKER_COOLDOWN seconds, doubling each time it trips again
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 5 * 60
+MAX_COOLDOWN = 24 * 60 * 60
+
+# time to first byte assumed for mirrors we haven't seen yet
+DEFAULT_TTFB = 1.0
+
+# weight of the newest sample in the moving average of a mirror's TTFB
+TTFB_SMOOTHING = 0.3
+
+
+def mirror_key(url: str) -> str:
+    "Mirrors are tracked by host, so any URL on a mirror counts towards it"
+    return urlsplit(url).netloc or url
+
+
+class MirrorHealth:
+    """
+    Tracks how mirrors behave across runs: how often they answer, how fast
+    the first byte arrives and how often they have the PDF. Mirrors that keep
+    failing are skipped for a while (circuit breaker).
+    """
+
+    def __init__(self, stats: dict | None = None):
+        self.stats: dict[str, dict] = stats or {}
+
+    @classmethod
+    def load(cls) -> "MirrorHealth":
+        return cls(cache.read_json(HEALTH_CACHE_FILE))
+
+    def save(self) -> None:
+        cache.write_json(HEALTH_CACHE_FILE, self.stats)
+
+    def _get(self, url: str) -> dict:
+        return self.stats.setdefault(
+            mirror_key(url),
+            {
+                "requests": 0,
+                "successes": 0,
+                "pdf_hits": 0,
+                "ttfb": None,
+                "failures_in_row": 0,
+                "trips": 0,
+                "open_until": 0,
+            },
+        )
+
+    def record_success(self, url: str, ttfb: float) -> None:
+        stats = self._get(url)
+        stats["requests"] += 1
+        stats["successes"] += 1
+        stats["failures_in_row"] = 0
+        stats["trips"] = 0
+        stats["open_until"] = 0
+        if stats["ttfb"] is None:
+            stats["ttfb"] = ttfb
+        else:
+            stats["ttfb"] += TTFB_SMOOTHING * (ttfb - stats["ttfb"])
+
+    def record_failure(self, url: str) -> None:
+        stats = self._get(url)
+        stats["requests"] += 1
+        stats["failures_in_row"] += 1
+        if stats["failures_in_row"] >= BREAKER_THRESHOLD:
+            cooldown = min(BREAKER_COOLDOWN * 2 ** stats["trips"], MAX_COOLDOWN)
+            stats["trips"] += 1
+            stats["failures_in_row"] = 0
+            stats["open_until"] = time.time() + cooldown
+            logger.info("{} keeps failing, skipping it for {}s", url, cooldown)
+
+    def record_pdf(self, url: str) -> None:
+        self._get(url)["pdf_hits"] += 1
+
+    def is_available(self, url: str) -> bool:
+        "Returns False while a mirror's circuit breaker is open"
+        stats = self.stats.get(mirror_key(url))
+        return stats is None or stats["open_until"] <= time.time()
+
+    def expected_time(self, url: str) -> float:
+        """
+        Estimates how long it takes to get a PDF link out of a mirror, given
+        its TTFB and how often it answers and has the paper. Lower is better.
+        """
+
+        stats = self.stats.get(mirror_key(url))
+        if stats is None:
+            return DEFAULT_TTFB / 0.25
+        ttfb = stats["ttfb"] if stats["ttfb"] is not None else DEFAULT_TTFB
+        # add-one smoothing so that new mirrors aren't ruled out early
+        success_rate = (stats["successes"] + 1) / (stats["requests"] + 2)
+        pdf_rate = (stats["pdf_hits"] + 1) / (stats["successes"] + 2)
+        return ttfb / (success_rate * pdf_rate)
+
+    def rank(self, urls: list[str]) -> list[str]:
+        """
+        Orders URLs from the most to the least promising mirror, leaving out
+        mirrors whose circuit breaker is open. If every mirror is out, they're
+        all returned so that there's still something to try.
+        """
+
+        available = [url for url in urls if self.is_available(url)] or urls
+        return sorted(available, key=self.expected_time)
+
+
+# health stats are loaded once and shared by every lookup in a run
+_health: MirrorHealth | None = None
+
+
+def get_health() -> MirrorHealth:
+    global _health
+    if _health is None:
+        _health = MirrorHealth.load()
+    return _health
@@ -0,0 +1,40 @@
+import metrics
+from loguru import logger
+from parse.parse import PDFLinkFinder
+
+# the PDF link sits near the top of landing pages, so there's no point in
+# reading more than this many bytes of one
+LANDING_PAGE_LIMIT = 256 * 1024
+
+# landing pages are read in chunks of this size
+CHUNK_SIZE = 16 * 1024
+
+
+async def read_pdf_url(res, limit: int = LANDING_PAGE_LIMIT) -> str | None:
+    """
+    Stream a landing page and return the embedded link to a PDF in it, or
+    None if there isn't one within the first `limit` bytes. Reading stops as
+    soon as a PDFObject link is found, and the connection is closed rather
+    than drained, so the rest of the page is never downloaded.
+    """
+
+    finder = PDFLinkFinder()
+    size = 0
+    try:
+        async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            pdf_url = finder.feed(chunk)
+            if pdf_url is not None:
+                return pdf_url
+            if size >= limit:
+                pdf_url = finder.close()
+                if pdf_url is None:
+                    logger.info(
+                        "No PDF link in the first {} bytes of {}", size, res.url
+                    )
+                return pdf_url
+        return finder.close()
+    finally:
+        metrics.get_metrics().count("landing_page_bytes", size)
+        if not res.content.at_eof():
+            res.close()
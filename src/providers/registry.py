@@ -0,0 +1,64 @@
+from importlib.metadata import entry_points
+
+import providers.arxiv as arxiv
+import providers.scidb as scidb
+import providers.scihub as scihub
+from loguru import logger
+from providers.base import Provider
+
+# packages can add providers by exposing a Provider subclass or instance
+# under this entry point group
+ENTRY_POINT_GROUP = "papers_dl.providers"
+
+# registered providers by name, loaded on first use
+_providers: dict[str, Provider] | None = None
+
+
+def register(provider: Provider) -> None:
+    "Add a provider, replacing any registered provider with the same name"
+    get_providers()
+    _providers[provider.name] = provider
+
+
+def load_plugins() -> list[Provider]:
+    plugins = []
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        try:
+            plugin = entry_point.load()
+            if isinstance(plugin, type):
+                plugin = plugin()
+            if not isinstance(plugin, Provider):
+                raise TypeError(f"{plugin!r} isn't a Provider")
+        except Exception as e:
+            logger.error("Couldn't load provider {}: {}", entry_point.name, e)
+            continue
+        plugins.append(plugin)
+    return plugins
+
+
+def get_providers() -> list[Provider]:
+    global _providers
+    if _providers is None:
+        builtin = [scidb.SciDB(), scihub.SciHub(), arxiv.Arxiv()]
+        _providers = {provider.name: provider for provider in builtin}
+        for plugin in load_plugins():
+            _providers[plugin.name] = plugin
+    return list(_providers.values())
+
+
+def select_providers(providers: str) -> list[Provider]:
+    """
+    Returns the providers picked by a comma separated list of names, as
+    given with -p, or every provider for "all".
+    """
+
+    if providers == "all":
+        return get_providers()
+
+    names = [name.strip() for name in providers.split(",")]
+    selected = []
+    for provider in get_providers():
+        provider = provider.select(names)
+        if provider is not None:
+            selected.append(provider)
+    return selected
@@ -1,11 +1,17 @@
 from urllib.parse import urljoin
 
+import metrics
+import providers.landing as landing
 from loguru import logger
-from parse.parse import find_pdf_url, parse_ids_from_text
+from parse.parse import parse_ids_from_text
+from providers import ProviderUnavailableError
+from providers.base import Provider
+
+SCIDB_URL = "https://annas-archive.org/scidb/"
 
 
 async def get_url(session, identifier):
-    base_url = "https://annas-archive.org/scidb/"
+    base_url = SCIDB_URL
     # TODO: add support for .se and .li base_urls
 
     is_doi = parse_ids_from_text(identifier, ["doi"])
@@ -13,13 +19,30 @@ async def get_url(session, identifier):
         url = urljoin(base_url, identifier)
         logger.info("searching SciDB: {}", url)
         try:
-            res = await session.get(url)
+            with metrics.get_metrics().span("scidb.landing_page"):
+                async with session.get(url) as res:
+                    if not 200 <= res.status < 300:
+                        raise ProviderUnavailableError(
+                            f"SciDB answered with status {res.status}"
+                        )
+                    pdf_url = await landing.read_pdf_url(res)
+        except ProviderUnavailableError:
+            raise
         except Exception as e:
             logger.error("Couldn't connect to SciDB: {}", e)
-            return None
-        pdf_url = find_pdf_url(await res.read())
+            raise ProviderUnavailableError("SciDB") from e
         if pdf_url is None:
             logger.info("No direct link to PDF found from SciDB")
         return pdf_url
 
     return None
+
+
+class SciDB(Provider):
+    "SciDB, Anna's Archive's index of papers by DOI"
+
+    name = "scidb"
+
+    async def get_urls(self, session, identifier: str) -> list[str]:
+        pdf_url = await get_url(session, identifier)
+        return [pdf_url] if pdf_url is not None else []
@@ -1,27 +1,106 @@
 import asyncio
 import enum
 import re
+import time
 from urllib.parse import urljoin
 
-import aiohttp
-from bs4 import BeautifulSoup
+import cache
+import metrics
+import providers.health as health
+import providers.landing as landing
 from loguru import logger
-from parse.parse import find_pdf_url
+from providers import ProviderUnavailableError
+from providers.base import Provider, match_available_providers
+from session import create_session
 
 # URL-DIRECT - openly accessible paper
 # URL-NON-DIRECT - pay-walled paper
 # PMID - PubMed ID
 # DOI - digital object identifier
-IDClass = enum.Enum("identifier", ["URL-DIRECT", "URL-NON-DIRECT", "PMD", "DOI"])
+IDClass = enum.Enum("identifier", ["URL-DIRECT", "URL-NON-DIRECT", "PMID", "DOI"])
 
-DEFAULT_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15"
+SCIHUB_MIRRORS_URL = "https://sci-hub.now.sh/"
+
+# discovered mirrors are cached on disk for this many seconds
+MIRRORS_TTL = 24 * 60 * 60
+MIRRORS_CACHE_FILE = "scihub_mirrors.json"
+
+# seconds before mirrors are looked for again after a discovery that failed
+DISCOVERY_RETRY = 10 * 60
+
+# seconds to wait for a mirror before also trying the next one
+HEDGE_DELAY = 2.0
+
+# mirrors found during this run, shared by every lookup, and when they were
+# found. Mirrors without a time are used for as long as the process runs.
+_mirrors: list[str] | None = None
+_mirrors_updated: float | None = None
+_mirrors_lock = asyncio.Lock()
 
 
 class IdentifierNotFoundError(Exception):
     pass
 
 
-async def get_available_scihub_urls() -> list[str]:
+async def get_available_scihub_urls(
+    session=None, refresh: bool = False, ttl: float = MIRRORS_TTL
+) -> list[str]:
+    """
+    Returns known Sci-Hub urls. Mirrors are discovered once and cached in
+    memory and on disk for `ttl` seconds, so that a long-running process
+    picks up new mirrors too; pass refresh=True to rediscover them.
+    """
+
+    global _mirrors, _mirrors_updated
+
+    async with _mirrors_lock:
+        if (
+            _mirrors is not None
+            and not refresh
+            and (_mirrors_updated is None or time.time() - _mirrors_updated < ttl)
+        ):
+            return _mirrors
+
+        cached_urls, updated = cached_scihub_urls()
+        if not refresh and cached_urls and time.time() - (updated or 0) < ttl:
+            logger.info("using cached Sci-Hub urls")
+            _mirrors = cached_urls
+            _mirrors_updated = updated
+            return _mirrors
+
+        if session is None:
+            async with create_session() as session:
+                urls = await discover_scihub_urls(session)
+        else:
+            urls = await discover_scihub_urls(session)
+        if urls:
+            _mirrors_updated = time.time()
+            cache.write_json(
+                MIRRORS_CACHE_FILE, {"updated": _mirrors_updated, "urls": urls}
+            )
+        else:
+            if cached_urls:
+                # an expired list is better than none at all
+                logger.info("Couldn't refresh Sci-Hub urls, using expired cache")
+                urls = cached_urls
+            # try again soon rather than after a whole ttl
+            _mirrors_updated = time.time() - ttl + DISCOVERY_RETRY
+
+        _mirrors = urls
+        return _mirrors
+
+
+def cached_scihub_urls() -> tuple[list[str], float | None]:
+    """
+    Returns the Sci-Hub urls cached on disk and the time they were found,
+    without looking for new ones.
+    """
+
+    cached = cache.read_json(MIRRORS_CACHE_FILE) or {}
+    return cached.get("urls") or [], cached.get("updated")
+
+
+async def discover_scihub_urls(session) -> list[str]:
     """
     Finds available Sci-Hub urls via https://sci-hub.now.sh/
     """
@@ -30,11 +109,13 @@ async def get_available_scihub_urls() -> list[str]:
     # the HTML more finely by navigating the parsed DOM, instead of relying
     # on filtering. That might be more brittle in case the HTML changes.
     # Generally, we don't need to get all URLs.
+    from bs4 import BeautifulSoup
+
     scihub_domain = re.compile(r"^http[s]*://sci.hub", flags=re.IGNORECASE)
     urls = []
 
     try:
-        async with aiohttp.request("GET", "https://sci-hub.now.sh/") as res:
+        async with session.get(SCIHUB_MIRRORS_URL) as res:
             s = BeautifulSoup(await res.text(), "html.parser")
     except Exception as e:
         logger.info("Couldn't find Sci-Hub URLs: {}", e)
@@ -64,52 +145,107 @@ async def get_direct_urls(
     session,
     identifier: str,
     base_urls: list[str] | None = None,
+    hedge_delay: float = HEDGE_DELAY,
 ) -> list[str]:
     """
     Finds the direct source url for a given identifier.
+
+    Mirrors are tried from the fastest healthy one down. Another mirror is
+    only tried when the previous one fails or hasn't answered within
+    `hedge_delay` seconds, and the search stops at the first PDF link found.
+    Raises ProviderUnavailableError if no mirror answered at all, and an
+    error status doesn't count as an answer.
     """
 
+    if classify(identifier) == IDClass["URL-DIRECT"]:
+        return [identifier]
+
+    run_metrics = metrics.get_metrics()
     if base_urls is None:
-        base_urls = await get_available_scihub_urls()
+        with run_metrics.span("scihub.mirrors"):
+            base_urls = await get_available_scihub_urls(session)
+
+    mirror_health = health.get_health()
+    base_urls = mirror_health.rank(base_urls)
 
     logger.info("searching Sci-Hub urls: {}", base_urls)
+    answered = False
 
-    # catch exceptions so that they don't cancel the task group
-    async def get_wrapper(url):
+    # catch exceptions so that a failing mirror doesn't stop the search
+    async def lookup(base_url) -> str | None:
+        nonlocal answered
+        url = urljoin(base_url, identifier)
+        start = time.monotonic()
         try:
-            return await session.get(url)
+            with run_metrics.span("scihub.landing_page"):
+                async with session.get(url) as res:
+                    if not 200 <= res.status < 300:
+                        # e.g. a 503 while the mirror is down, or a 403 from
+                        # bot protection, which says nothing about the paper
+                        logger.info("{} answered with status {}", url, res.status)
+                        mirror_health.record_failure(url)
+                        run_metrics.count("mirror_failures")
+                        return None
+                    answered = True
+                    mirror_health.record_success(url, time.monotonic() - start)
+                    path = await landing.read_pdf_url(res)
+                    mirror_url = res.url.human_repr()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.info("Couldn't connect to {}: {}", url, e)
+            mirror_health.record_failure(url)
+            run_metrics.count("mirror_failures")
             return None
 
-    if classify(identifier) == IDClass["URL-DIRECT"]:
-        return [identifier]
+        if isinstance(path, list):
+            path = path[0]
+        if not isinstance(path, str):
+            return None
 
-    async with asyncio.TaskGroup() as tg:
-        tasks = [
-            tg.create_task(get_wrapper(urljoin(base_url, identifier)))
-            for base_url in base_urls
-        ]
+        mirror_health.record_pdf(url)
+        if path.startswith("//"):
+            return "https:" + path
+        return urljoin(mirror_url, path)
+
+    remaining = iter(base_urls)
+
+    def launch_next(pending: set) -> None:
+        base_url = next(remaining, None)
+        if base_url is not None:
+            pending.add(asyncio.create_task(lookup(base_url)))
 
     direct_urls = []
+    pending = set()
+    launch_next(pending)
     try:
-        for task in tasks:
-            res = await task
-            if res is None:
+        while pending and not direct_urls:
+            done, pending = await asyncio.wait(
+                pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                # the latency budget ran out, hedge with the next mirror
+                run_metrics.count("mirror_hedges")
+                launch_next(pending)
                 continue
-            path = find_pdf_url(await res.text())
-            if isinstance(path, list):
-                path = path[0]
-            if isinstance(path, str) and path.startswith("//"):
-                direct_urls.append("https:" + path)
-            elif isinstance(path, str) and path.startswith("/"):
-                direct_urls.append(urljoin(res.url.human_repr(), path))
-
+            for task in done:
+                direct_url = task.result()
+                if direct_url is not None:
+                    direct_urls.append(direct_url)
+                else:
+                    launch_next(pending)
     except Exception as err:
         logger.error("Error while looking for PDF urls: {}", err)
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        mirror_health.save()
 
     if not direct_urls:
         logger.info("No direct link to PDF found from Sci-Hub")
+        if not answered:
+            raise ProviderUnavailableError("Sci-Hub")
 
     return list(set(direct_urls))
 
@@ -131,3 +267,37 @@ def classify(identifier) -> IDClass:
         return IDClass["PMID"]
     else:
         return IDClass["DOI"]
+
+
+class SciHub(Provider):
+    "Sci-Hub, through the fastest of its available mirrors"
+
+    name = "scihub"
+    # mirrors are tried one after the other when they're slow
+    timeout = 60
+
+    def __init__(self, mirrors: list[str] | None = None):
+        # parts of mirror urls picked with -p, to use instead of every mirror
+        self.mirrors = mirrors
+        if mirrors:
+            self.name = " ".join(["scihub", *mirrors])
+
+    def select(self, names: list[str]) -> Provider | None:
+        if match_available_providers(names, [SciHub.name]):
+            return self
+        # names that look like host names pick mirrors (e.g. sci-hub.ee)
+        mirrors = [name for name in names if "." in name]
+        return SciHub(mirrors) if mirrors else None
+
+    async def get_urls(self, session, identifier: str) -> list[str]:
+        base_urls = None
+        if self.mirrors:
+            base_urls = match_available_providers(
+                self.mirrors, await get_available_scihub_urls(session)
+            )
+            logger.info("matching scihub urls: {}", base_urls)
+            if not base_urls:
+                raise ProviderUnavailableError(
+                    f"No Sci-Hub mirror matches {self.mirrors}"
+                )
+        return await get_direct_urls(session, identifier, base_urls)
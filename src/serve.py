@@ -0,0 +1,179 @@
+import asyncio
+import os
+
+import metrics
+from aiohttp import web
+from fetch import fetch
+from loguru import logger
+from parse.parse import id_patterns, parse_ids_from_text, scan_file
+from session import CONNECTION_LIMIT, PER_HOST_LIMIT, create_session
+
+
+class PaperService:
+    """
+    The state `papers-dl serve` keeps warm between requests: one HTTP session
+    and its pool of open connections, the paper store, and the processes
+    titles are looked up in. Mirror lists, mirror health and known misses
+    are kept by their modules, so they stay loaded for the life of the
+    process too.
+    """
+
+    def __init__(
+        self,
+        providers: str = "all",
+        out_dir: str = ".",
+        store=None,
+        rename: bool = True,
+        executor=None,
+        limit: int = CONNECTION_LIMIT,
+        per_host: int = PER_HOST_LIMIT,
+        user_agent: str | None = None,
+    ):
+        self.providers = providers
+        self.out_dir = out_dir
+        self.store = store
+        self.rename = rename
+        self.executor = executor
+        self.limit = limit
+        self.per_host = per_host
+        self.user_agent = user_agent
+        self.session = None
+
+    async def context(self, app):
+        "Keeps the session open for as long as the app runs (see cleanup_ctx)"
+        async with create_session(self.limit, self.per_host, self.user_agent) as sess:
+            self.session = sess
+            yield
+            self.session = None
+
+    async def fetch(self, identifier: str) -> tuple | None:
+        """
+        Download a paper (see fetch.download_paper). Concurrent requests for
+        the same paper, or for papers at the same URL, share one download.
+        """
+
+        return await fetch.download_paper(
+            self.session,
+            identifier,
+            self.providers,
+            self.out_dir,
+            self.store,
+            rename=self.rename,
+            executor=self.executor,
+        )
+
+
+# the service behind an app, for its request handlers
+SERVICE = web.AppKey("service", PaperService)
+
+
+async def read_request(request) -> dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="The request body isn't valid JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="The request body should be a JSON object")
+    return body
+
+
+async def handle_fetch(request) -> web.Response:
+    """
+    POST /fetch {"id": "<identifier>"}: download a paper. Responds with the
+    same object as a line of `papers-dl fetch --from` output, with status 404
+    if no provider had the paper.
+    """
+
+    body = await read_request(request)
+    identifier = body.get("id")
+    if not isinstance(identifier, str) or not identifier.strip():
+        raise web.HTTPBadRequest(text='Expected {"id": "<identifier>"}')
+    identifier = identifier.strip()
+
+    try:
+        result = await request.app[SERVICE].fetch(identifier)
+    except Exception as e:
+        logger.error("Failed to fetch {}: {}", identifier, e)
+        result = None
+
+    if result is None:
+        return web.json_response(
+            {"id": identifier, "url": None, "path": None}, status=404
+        )
+    path, url = result
+    return web.json_response({"id": identifier, "url": url, "path": path})
+
+
+async def handle_parse(request) -> web.Response:
+    """
+    POST /parse {"text": "..."} or {"path": "<file>"}, optionally with
+    "types": ["doi", ...]: find identifiers in a text or in a local file.
+    Responds with {"ids": [{"id": ..., "type": ...}, ...]}.
+    """
+
+    body = await read_request(request)
+    id_types = body.get("types") or list(id_patterns)
+    if not isinstance(id_types, list) or not set(id_types) <= set(id_patterns):
+        raise web.HTTPBadRequest(text=f"types should be in {list(id_patterns)}")
+
+    loop = asyncio.get_running_loop()
+    if isinstance(body.get("text"), str):
+        ids = await loop.run_in_executor(
+            None, parse_ids_from_text, body["text"], id_types
+        )
+    elif isinstance(body.get("path"), str):
+        try:
+            ids = await loop.run_in_executor(
+                None, lambda: list(scan_file(body["path"], id_types))
+            )
+        except OSError as e:
+            raise web.HTTPBadRequest(text=f"Couldn't read {body['path']}: {e}")
+    else:
+        raise web.HTTPBadRequest(text='Expected {"text": "..."} or {"path": "..."}')
+    return web.json_response({"ids": ids})
+
+
+async def handle_metrics(request) -> web.Response:
+    """
+    GET /metrics: the time spent in each stage of fetching papers and the
+    requests, bytes and retries so far, in the Prometheus text format.
+    """
+
+    return web.Response(
+        text=metrics.get_metrics().prometheus(),
+        content_type="text/plain",
+    )
+
+
+def create_app(service: PaperService) -> web.Application:
+    app = web.Application()
+    app[SERVICE] = service
+    app.cleanup_ctx.append(service.context)
+    app.router.add_post("/fetch", handle_fetch)
+    app.router.add_post("/parse", handle_parse)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def serve(
+    app: web.Application,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    path: str | None = None,
+) -> None:
+    "Serve the app on a TCP port, or on a Unix socket if path is given, until cancelled"
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        if path is not None:
+            site = web.UnixSite(runner, path)
+        else:
+            site = web.TCPSite(runner, host, port)
+        await site.start()
+        logger.info("Serving on {}", site.name)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1,52 @@
+import aiohttp
+import metrics
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15"
+
+# connections open at once, in total and to a single host
+CONNECTION_LIMIT = 32
+PER_HOST_LIMIT = 4
+
+# seconds a resolved host name is reused for, so that every lookup against
+# a mirror doesn't go through DNS again
+DNS_CACHE_TTL = 10 * 60
+
+# seconds an idle connection is kept open for the next request to the same
+# host, which saves a TCP and TLS handshake
+KEEPALIVE_TIMEOUT = 60
+
+# there's no overall limit, since big PDFs on slow mirrors can take a while,
+# but a host that doesn't connect or stops sending is given up on
+TIMEOUT = aiohttp.ClientTimeout(total=None, connect=15, sock_read=30)
+
+
+def create_session(
+    limit: int = CONNECTION_LIMIT,
+    per_host: int = PER_HOST_LIMIT,
+    user_agent: str | None = None,
+    trace_configs: list[aiohttp.TraceConfig] | None = None,
+) -> aiohttp.ClientSession:
+    """
+    Create the HTTP session every provider makes its requests through. It
+    keeps a pool of warm connections and cached DNS lookups for the whole
+    run, and sends the same timeouts and headers everywhere. trace_configs
+    are passed on to the session, to follow its requests and connections.
+    While metrics are enabled, the session's requests and bytes are counted.
+    """
+
+    run_metrics = metrics.get_metrics()
+    if run_metrics.enabled:
+        trace_configs = [*(trace_configs or []), run_metrics.trace_config()]
+
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=per_host,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=TIMEOUT,
+        headers={"User-Agent": user_agent or DEFAULT_USER_AGENT},
+        trace_configs=trace_configs,
+    )
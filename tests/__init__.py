@@ -1,6 +1,68 @@
 import sys
 import os
+import tempfile
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
 )
+
+import fetch.misses as misses
+import metrics
+import providers.health as health
+import providers.registry as registry
+import providers.scihub as scihub
+
+
+def reset_state():
+    "Forget the state that modules share for the length of a run"
+
+    if misses._misses is not None:
+        misses._misses.close()
+    misses._misses = None
+    health._health = None
+    registry._providers = None
+    scihub._mirrors = None
+    scihub._mirrors_updated = None
+    metrics._metrics = None
+
+
+class ResetStateMixin:
+    """
+    Gives each test an empty cache directory and a fresh copy of every
+    module-level singleton, and puts them back after the test. Mix it in
+    before the TestCase class.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.env = mock.patch.dict(
+            os.environ, {"PAPERS_DL_CACHE_DIR": self.cache_dir.name}
+        )
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        reset_state()
+        self.addCleanup(reset_state)
+
+
+class LocalServerMixin:
+    """
+    Starts local HTTP servers for a test, which are closed after it. Mix it
+    in before IsolatedAsyncioTestCase.
+    """
+
+    async def start_server(self, routes: dict) -> TestServer:
+        "Start a server answering GET requests on each path with its handler"
+
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_get(path, handler)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        return server
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+import fetch.misses as misses
+import providers.arxiv as arxiv
+import providers.scidb as scidb
+from benchmarks.farm import MirrorFarm
+from benchmarks.run import bench_fetch, identifiers, percentile, use_farm
+from tests import ResetStateMixin
+
+
+class TestBenchmarks(ResetStateMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.providers = (scidb.SCIDB_URL, arxiv.ARXIV_PDF_URL)
+        misses.get_misses().ttl = 0
+
+        self.runner, urls = await MirrorFarm(latency=0.01, pdf_size=4096).start()
+        use_farm(urls)
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        scidb.SCIDB_URL, arxiv.ARXIV_PDF_URL = self.providers
+        self.out_dir.cleanup()
+
+    async def test_bench_fetch(self):
+        ids = identifiers(6, 0.5)
+        out_dir = os.path.join(self.out_dir.name, "out")
+        results = await bench_fetch(ids, 3, 4, out_dir)
+
+        self.assertEqual(results["found"], 6)
+        self.assertEqual(len(os.listdir(out_dir)), 6)
+        self.assertGreaterEqual(results["requests"], 6)
+        self.assertGreater(results["connections"], 0)
+        self.assertIsNotNone(results["latency"]["p99"])
+
+    def test_percentile(self):
+        samples = [float(i) for i in range(1, 101)]
+        self.assertEqual(percentile(samples, 50), 50.0)
+        self.assertEqual(percentile(samples, 99), 99.0)
+        self.assertEqual(percentile([3.0], 90), 3.0)
+        self.assertIsNone(percentile([], 50))
@@ -1,10 +1,17 @@
-import unittest
+import json
+import os
 import subprocess
 import sys
+import tempfile
+import time
+import unittest
 
 test_paper_id = "10.1016/j.cub.2019.11.030"
 test_paper_title = "Parrots Voluntarily Help Each Other to Obtain Food Rewards"
 
+# microseconds `papers-dl parse` may spend importing modules
+import_budget_us = 250_000
+
 
 class TestCLI(unittest.TestCase):
     def test_parse_command_doi_csv(self):
@@ -78,3 +85,77 @@ class TestCLI(unittest.TestCase):
         result = subprocess.run(args, input=input_data, capture_output=True, text=True)
         self.assertIn('{"id": "978-1-60198-482-1", "type": "isbn"}', result.stdout)
         self.assertIn('{"id": "978-1-60198-483-8", "type": "isbn"}', result.stdout)
+
+    def test_parse_command_directory_source(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "src/papers_dl.py",
+                "parse",
+                "-m",
+                "doi",
+                "-f",
+                "csv",
+                "--source",
+                "-p",
+                "tests/documents",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        self.assertIn(
+            "10.1109/83.544569,doi,tests/documents/bsp-tree.html", result.stdout
+        )
+        self.assertIn("10.1016/j.cub.2019.11.030,doi,", result.stdout)
+        self.assertEqual(result.stdout.count("10.1016/j.cub.2019.11.030,doi,"), 1)
+
+    def test_parse_command_import_time(self):
+        "Test that parse doesn't import the networking and PDF libraries."
+
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "src/papers_dl.py",
+                "parse",
+                "-m",
+                "doi",
+                "-p",
+                "tests/documents/bsp-tree.html",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        self.assertIn("10.1109/83.544569", result.stdout)
+
+        # lines look like "import time:  self [us] | cumulative | package"
+        imports = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                self_time, _, name = line.removeprefix("import time:").split("|")
+                if self_time.strip().isdigit():
+                    imports[name.strip()] = int(self_time)
+
+        for module in ("aiohttp", "bs4", "fitz", "pymupdf", "pdf2doi"):
+            self.assertNotIn(module, imports)
+        # all imports, including the interpreter's own, fit in a budget that
+        # the heavy libraries alone used to blow several times over
+        self.assertLess(sum(imports.values()), import_budget_us)
+
+    def test_mirrors_list_reads_cache(self):
+        "Test that listing mirrors prints the cache without going online."
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env = {**os.environ, "PAPERS_DL_CACHE_DIR": cache_dir}
+            args = [sys.executable, "src/papers_dl.py", "mirrors", "list"]
+
+            result = subprocess.run(args, capture_output=True, text=True, env=env)
+            self.assertIn("No cached Sci-Hub mirrors", result.stdout)
+
+            urls = ["https://sci-hub.ee", "https://sci-hub.ru"]
+            with open(os.path.join(cache_dir, "scihub_mirrors.json"), "w") as f:
+                json.dump({"updated": time.time() - 2 * 60 * 60, "urls": urls}, f)
+            result = subprocess.run(args, capture_output=True, text=True, env=env)
+            self.assertEqual(result.stdout.split(), urls)
+            self.assertIn("found 2h 0m ago", result.stderr)
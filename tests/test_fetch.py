@@ -1,15 +1,822 @@
+import hashlib
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 import aiohttp
 import asyncio
 
-from src.providers.scihub import get_available_scihub_urls
+import cache
+import providers.arxiv as arxiv
+import providers.health as health
+import providers.landing as landing
+import providers.registry as registry
+import providers.scidb as scidb
+import providers.scihub as scihub
+import session
+from aiohttp import web
+import fetch.download as download
+import fetch.metadata as metadata
+import fetch.misses as misses
+import fitz
+import metrics
+from fetch import fetch
+from fetch.batch import fetch_batch, read_identifiers
+from fetch.singleflight import SingleFlight
+from fetch.store import PaperStore
+from providers import ProviderUnavailableError
+from providers.base import Provider
+from tests import LocalServerMixin, ResetStateMixin
 
 
-class TestSciHub(unittest.IsolatedAsyncioTestCase):
+class TestSciHub(ResetStateMixin, unittest.IsolatedAsyncioTestCase):
     async def test_scihub_up(self):
         """
         Test to verify that `scihub.now.sh` is available
         """
-        urls = await get_available_scihub_urls()
+        # ask it directly, rather than through the cached mirrors
+        async with session.create_session() as sess:
+            urls = await scihub.discover_scihub_urls(sess)
         self.assertIsNotNone(urls, "Failed to find Sci-Hub domains")
+
+
+class TestSciHubMirrors(ResetStateMixin, unittest.IsolatedAsyncioTestCase):
+    async def test_cached_mirrors(self):
+        urls = ["https://sci-hub.ee", "https://sci-hub.ru"]
+        cache.write_json(
+            scihub.MIRRORS_CACHE_FILE, {"updated": time.time(), "urls": urls}
+        )
+        self.assertEqual(await scihub.get_available_scihub_urls(), urls)
+
+        # the mirrors are remembered for the rest of the run
+        os.remove(os.path.join(self.cache_dir.name, scihub.MIRRORS_CACHE_FILE))
+        self.assertEqual(await scihub.get_available_scihub_urls(), urls)
+
+    async def test_mirrors_expire_in_memory(self):
+        urls = ["https://sci-hub.ee"]
+        cache.write_json(
+            scihub.MIRRORS_CACHE_FILE, {"updated": time.time(), "urls": urls}
+        )
+        self.assertEqual(await scihub.get_available_scihub_urls(ttl=60), urls)
+
+        # a long-running process looks again once the mirrors are out of date
+        later = time.time() + 61
+        new_urls = ["https://sci-hub.ru"]
+        cache.write_json(
+            scihub.MIRRORS_CACHE_FILE, {"updated": later, "urls": new_urls}
+        )
+        with mock.patch("time.time", return_value=later):
+            self.assertEqual(await scihub.get_available_scihub_urls(ttl=60), new_urls)
+
+
+class TestSession(LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def page(request):
+            port = request.transport.get_extra_info("peername")[1]
+            self.requests.append((port, request.headers.get("User-Agent")))
+            return web.Response(text="<html></html>", content_type="text/html")
+
+        self.server = await self.start_server({"/{path:.*}": page})
+
+    async def test_warm_connections(self):
+        async with session.create_session() as sess:
+            for path in ("/a", "/b", "/c"):
+                async with sess.get(self.server.make_url(path)) as res:
+                    await res.read()
+
+        # every request went over the same connection, with the default headers
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len({port for port, _ in self.requests}), 1)
+        self.assertEqual(
+            {agent for _, agent in self.requests}, {session.DEFAULT_USER_AGENT}
+        )
+
+    async def test_user_agent(self):
+        async with session.create_session(user_agent="papers-dl") as sess:
+            async with sess.get(self.server.make_url("/")) as res:
+                await res.read()
+        self.assertEqual(self.requests[0][1], "papers-dl")
+
+
+class TestMirrorHealth(unittest.TestCase):
+    def test_rank_by_expected_time(self):
+        mirror_health = health.MirrorHealth()
+        mirror_health.record_success("https://slow.example/a", 3.0)
+        mirror_health.record_pdf("https://slow.example/a")
+        mirror_health.record_success("https://fast.example/a", 0.1)
+        mirror_health.record_pdf("https://fast.example/a")
+        self.assertEqual(
+            mirror_health.rank(["https://slow.example", "https://fast.example"]),
+            ["https://fast.example", "https://slow.example"],
+        )
+
+    def test_circuit_breaker(self):
+        mirror_health = health.MirrorHealth()
+        for _ in range(health.BREAKER_THRESHOLD):
+            mirror_health.record_failure("https://down.example/a")
+        self.assertFalse(mirror_health.is_available("https://down.example"))
+        self.assertEqual(
+            mirror_health.rank(["https://down.example", "https://up.example"]),
+            ["https://up.example"],
+        )
+
+
+class TestMisses(ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    def test_backoff(self):
+        known_misses = misses.MissCache(ttl=10)
+        with mock.patch("time.time", return_value=1000):
+            known_misses.record_miss("10.1000/ABC", "scidb")
+            # identifiers are normalized, and misses are per provider
+            self.assertTrue(known_misses.is_miss("doi:10.1000/abc", "scidb"))
+            self.assertFalse(known_misses.is_miss("10.1000/abc", "scihub"))
+        with mock.patch("time.time", return_value=1011):
+            self.assertFalse(known_misses.is_miss("10.1000/abc", "scidb"))
+            known_misses.record_miss("10.1000/abc", "scidb")
+        with mock.patch("time.time", return_value=1011 + 10 * misses.MISS_BACKOFF - 1):
+            self.assertTrue(known_misses.is_miss("10.1000/abc", "scidb"))
+        known_misses.record_hit("10.1000/abc", "scidb")
+        self.assertFalse(known_misses.is_miss("10.1000/abc", "scidb"))
+
+    def test_forget_old_misses(self):
+        path = os.path.join(self.cache_dir.name, misses.MISSES_DB_FILE)
+        known_misses = misses.MissCache(path, ttl=10)
+        with mock.patch("time.time", return_value=1000):
+            known_misses.record_miss("10.1000/abc", "scidb")
+        known_misses.close()
+
+        # misses long past their re-check are dropped when the cache is opened
+        with mock.patch("time.time", return_value=1010 + misses.MAX_MISS_TTL + 1):
+            known_misses = misses.MissCache(path, ttl=10)
+        count = known_misses.db.execute("SELECT COUNT(*) FROM misses").fetchone()
+        known_misses.close()
+        self.assertEqual(count, (0,))
+
+    async def test_skip_known_misses(self):
+        calls = []
+
+        async def get_url(session, identifier):
+            calls.append(identifier)
+            return None
+
+        async def unreachable(session, identifier):
+            calls.append(identifier)
+            raise ProviderUnavailableError("SciDB")
+
+        with mock.patch.object(scidb, "get_url", get_url):
+            self.assertEqual(await fetch.get_urls(None, "10.1000/abc", "scidb"), [])
+            self.assertEqual(await fetch.get_urls(None, "10.1000/abc", "scidb"), [])
+        self.assertEqual(calls, ["10.1000/abc"])
+
+        # the miss is remembered across runs
+        misses.get_misses().close()
+        misses._misses = None
+        with mock.patch.object(scidb, "get_url", unreachable):
+            await fetch.get_urls(None, "10.1000/abc", "scidb")
+            # a provider that can't be reached isn't a miss
+            await fetch.get_urls(None, "10.1000/def", "scidb")
+            await fetch.get_urls(None, "10.1000/def", "scidb")
+        self.assertEqual(calls, ["10.1000/abc", "10.1000/def", "10.1000/def"])
+
+    async def test_error_status_is_not_a_miss(self):
+        async def down(request):
+            return web.Response(status=503, text="Service Unavailable")
+
+        server = await self.start_server({"/{path:.*}": down})
+
+        scihub._mirrors = [str(server.make_url("/scihub/"))]
+        with mock.patch.object(scidb, "SCIDB_URL", str(server.make_url("/scidb/"))):
+            async with aiohttp.ClientSession() as sess:
+                urls = await fetch.get_urls(sess, "10.1000/xyz", "scihub,scidb")
+
+        self.assertEqual(urls, [])
+        # an outage isn't remembered as the providers not having the paper
+        self.assertFalse(misses.get_misses().is_miss("10.1000/xyz", "scihub"))
+        self.assertFalse(misses.get_misses().is_miss("10.1000/xyz", "scidb"))
+
+
+class FakeProvider(Provider):
+    def __init__(self, name, urls, delay=0.0, priority=0, timeout=30):
+        self.name = name
+        self.urls = urls
+        self.delay = delay
+        self.priority = priority
+        self.timeout = timeout
+
+    async def get_urls(self, session, identifier):
+        await asyncio.sleep(self.delay)
+        return self.urls
+
+
+class TestProviders(ResetStateMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        # only the fake providers registered by each test
+        registry._providers = {}
+
+    def test_select(self):
+        registry._providers = None
+        names = [p.name for p in registry.select_providers("scidb, sci-hub.ee")]
+        self.assertEqual(names, ["scidb", "scihub sci-hub.ee"])
+        names = [p.name for p in registry.select_providers("all")]
+        self.assertEqual(names, ["scidb", "scihub", "arxiv"])
+
+    async def test_concurrent_lookups(self):
+        registry.register(FakeProvider("slow", ["https://slow/a.pdf"], delay=0.3))
+        registry.register(
+            FakeProvider("first", ["https://first/a.pdf"], delay=0.3, priority=1)
+        )
+        registry.register(
+            FakeProvider("stuck", ["https://stuck/a.pdf"], delay=5, timeout=0.1)
+        )
+
+        start = time.monotonic()
+        urls = await fetch.get_urls(None, "10.1000/abc", "all")
+        # the providers searched at the same time, and the stuck one timed out
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(urls, ["https://first/a.pdf", "https://slow/a.pdf"])
+
+        urls = await fetch.get_urls(None, "10.1000/abc", "slow")
+        self.assertEqual(urls, ["https://slow/a.pdf"])
+
+
+class TestDirectUrls(LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    def test_arxiv_urls(self):
+        ids = [
+            ("arXiv:2407.13619", "https://arxiv.org/pdf/2407.13619.pdf"),
+            ("2407.13619v2", "https://arxiv.org/pdf/2407.13619v2.pdf"),
+            ("arXiv:math.GT/0309136", "https://arxiv.org/pdf/math/0309136.pdf"),
+            ("10.1016/j.cub.2019.11.030", None),
+        ]
+        for id, url in ids:
+            self.assertEqual(arxiv.pdf_url(id), url, id)
+
+    def test_classify(self):
+        self.assertEqual(
+            scihub.classify("https://a.org/b.pdf"), scihub.IDClass["URL-DIRECT"]
+        )
+        self.assertEqual(scihub.classify("31825866"), scihub.IDClass["PMID"])
+
+    def test_direct_urls(self):
+        self.assertEqual(
+            fetch.direct_urls("2407.13619", "all"),
+            ["https://arxiv.org/pdf/2407.13619.pdf"],
+        )
+        # arXiv ids only skip the providers when arXiv is one of them
+        self.assertEqual(fetch.direct_urls("2407.13619", "scidb"), [])
+        self.assertEqual(fetch.direct_urls("10.1016/j.cub.2019.11.030", "all"), [])
+
+    async def test_skip_providers(self):
+        async def pdf(request):
+            return web.Response(body=b"%PDF-1.4\n", content_type="application/pdf")
+
+        server = await self.start_server({"/paper.pdf": pdf})
+
+        async def get_urls(*args):
+            raise AssertionError("providers were searched")
+
+        url = str(server.make_url("/paper.pdf"))
+        with tempfile.TemporaryDirectory() as out_dir:
+            with mock.patch.object(fetch, "get_urls", get_urls):
+                async with aiohttp.ClientSession() as sess:
+                    path, pdf_url = await fetch.fetch(sess, url, "all", out_dir)
+            self.assertEqual(pdf_url, url)
+            self.assertTrue(os.path.exists(path))
+
+
+class TestSingleFlight(
+    ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase
+):
+    async def asyncSetUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        registry._providers = {}
+        self.bodies_sent = 0
+
+        async def pdf(request):
+            res = web.StreamResponse()
+            res.content_type = "application/pdf"
+            await res.prepare(request)
+            await res.write(b"%PDF-1.4\n" + b"0" * download.PDF_HEADER_LIMIT)
+            await asyncio.sleep(0.2)
+            await res.write(b"0" * 1024 * 1024)
+            self.bodies_sent += 1
+            return res
+
+        self.server = await self.start_server({"/paper.pdf": pdf})
+
+    async def asyncTearDown(self):
+        self.out_dir.cleanup()
+
+    async def test_single_flight(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(None)
+            await asyncio.sleep(0.1)
+            return len(calls)
+
+        results = await asyncio.gather(*(flights.do("key", call) for _ in range(3)))
+        self.assertEqual(results, [1, 1, 1])
+        # the next call for the key starts afresh
+        self.assertEqual(await flights.do("key", call), 2)
+
+        async def fail():
+            await asyncio.sleep(0.1)
+            raise ValueError("failed")
+
+        results = await asyncio.gather(
+            flights.do("fail", fail), flights.do("fail", fail), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_duplicate_downloads(self):
+        url = str(self.server.make_url("/paper.pdf"))
+        provider = FakeProvider("fake", [url])
+        registry.register(provider)
+
+        # the same DOI written two ways, and a different DOI at the same URL
+        identifiers = [
+            "10.1000/abc",
+            "https://doi.org/10.1000/ABC",
+            "10.1000/def",
+        ]
+        async with aiohttp.ClientSession() as sess:
+            results = [
+                result
+                async for result in fetch_batch(
+                    sess, identifiers, "fake", self.out_dir.name, rename="none"
+                )
+            ]
+
+        self.assertEqual(self.bodies_sent, 1)
+        self.assertEqual(len({result["path"] for result in results}), 1)
+        self.assertTrue(all(result["url"] == url for result in results))
+
+
+class TestSciHubHedging(
+    ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase
+):
+    async def asyncSetUp(self):
+        with open("tests/documents/scihub.html") as f:
+            page = f.read()
+        self.requests = []
+
+        async def slow(request):
+            self.requests.append("slow")
+            await asyncio.sleep(5)
+            return web.Response(text=page, content_type="text/html")
+
+        async def fast(request):
+            self.requests.append("fast")
+            return web.Response(text=page, content_type="text/html")
+
+        async def down(request):
+            self.requests.append("down")
+            return web.Response(status=503, text=page, content_type="text/html")
+
+        self.server = await self.start_server(
+            {"/slow/{id:.*}": slow, "/fast/{id:.*}": fast}
+        )
+
+        # mirror health is kept per host, so the failing mirror is separate
+        self.down_server = await self.start_server({"/down/{id:.*}": down})
+
+    async def test_hedge_to_next_mirror(self):
+        base_urls = [
+            str(self.server.make_url("/slow/")),
+            str(self.server.make_url("/fast/")),
+        ]
+        async with aiohttp.ClientSession() as sess:
+            urls = await scihub.get_direct_urls(
+                sess, "10.1016/j.cub.2019.11.030", base_urls, hedge_delay=0.1
+            )
+        self.assertEqual(
+            urls, ["https://sci.bban.top/pdf/10.1016/j.cub.2019.11.030.pdf"]
+        )
+        self.assertEqual(self.requests, ["slow", "fast"])
+
+    async def test_error_status_is_failure(self):
+        url = str(self.down_server.make_url("/down/"))
+        base_urls = [url, str(self.server.make_url("/fast/"))]
+        async with aiohttp.ClientSession() as sess:
+            urls = await scihub.get_direct_urls(
+                sess, "10.1016/j.cub.2019.11.030", base_urls
+            )
+        self.assertEqual(len(urls), 1)
+        self.assertEqual(self.requests, ["down", "fast"])
+
+        # a mirror that answers quickly with errors isn't a fast mirror
+        stats = health.get_health().stats[health.mirror_key(url)]
+        self.assertEqual(stats["successes"], 0)
+        self.assertEqual(stats["failures_in_row"], 1)
+        self.assertIsNone(stats["ttfb"])
+
+
+class TestLandingPage(LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        with open("tests/documents/scihub.html", "rb") as f:
+            self.page = f.read()
+
+        async def stalled(request):
+            # send the page a few bytes at a time, then never finish it
+            res = web.StreamResponse()
+            res.content_type = "text/html"
+            await res.prepare(request)
+            for i in range(0, len(self.page), 7):
+                await res.write(self.page[i : i + 7])
+            await res.write(b"<p>" * 1024)
+            await asyncio.sleep(5)
+            return res
+
+        async def huge(request):
+            res = web.StreamResponse()
+            res.content_type = "text/html"
+            await res.prepare(request)
+            while True:
+                await res.write(b"<p>filler</p>" * 1024)
+
+        self.server = await self.start_server({"/stalled": stalled, "/huge": huge})
+
+    async def test_stop_at_link(self):
+        start = time.monotonic()
+        async with aiohttp.ClientSession() as sess:
+            async with sess.get(self.server.make_url("/stalled")) as res:
+                pdf_url = await landing.read_pdf_url(res)
+        self.assertEqual(
+            pdf_url, "https://sci.bban.top/pdf/10.1016/j.cub.2019.11.030.pdf"
+        )
+        self.assertLess(time.monotonic() - start, 2)
+
+    async def test_byte_limit(self):
+        async with aiohttp.ClientSession() as sess:
+            async with sess.get(self.server.make_url("/huge")) as res:
+                pdf_url = await landing.read_pdf_url(res, limit=100_000)
+        self.assertIsNone(pdf_url)
+
+
+class TestRacePDF(LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pdf = b"%PDF-1.4\n" + b"0" * 4096
+        self.cancelled = []
+
+        async def html(request):
+            return web.Response(text="<html></html>", content_type="text/html")
+
+        async def fake_pdf(request):
+            return web.Response(
+                body=b"<html></html>", content_type="application/octet-stream"
+            )
+
+        async def pdf(request):
+            await asyncio.sleep(0.1)
+            return web.Response(body=self.pdf, content_type="application/pdf")
+
+        async def slow_pdf(request):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                self.cancelled.append(request.path)
+                raise
+            return web.Response(body=self.pdf, content_type="application/pdf")
+
+        self.server = await self.start_server(
+            {"/html": html, "/fake": fake_pdf, "/pdf": pdf, "/slow": slow_pdf}
+        )
+
+    async def test_first_pdf_wins(self):
+        urls = [
+            str(self.server.make_url(path))
+            for path in ("/slow", "/pdf", "/html", "/fake")
+        ]
+        async with aiohttp.ClientSession() as sess:
+            res, url, head = await fetch.race_pdf(sess, urls)
+            body = head + await res.read()
+            res.release()
+            # give the server a moment to notice the closed connection
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(url, urls[1])
+        self.assertEqual(body, self.pdf)
+        self.assertEqual(self.cancelled, ["/slow"])
+
+    async def test_stream_to_disk(self):
+        urls = [str(self.server.make_url("/pdf"))]
+        with tempfile.TemporaryDirectory() as out_dir:
+            async with aiohttp.ClientSession() as sess:
+                res, url, head = await fetch.race_pdf(sess, urls)
+                path = await download.download(sess, res, url, head, out_dir, "id")
+                res.release()
+
+            self.assertEqual(os.listdir(out_dir), [os.path.basename(path)])
+            self.assertEqual(
+                os.path.basename(path), hashlib.md5(self.pdf).hexdigest() + ".pdf"
+            )
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), self.pdf)
+
+    async def test_no_pdf(self):
+        urls = [str(self.server.make_url(path)) for path in ("/html", "/fake")]
+        async with aiohttp.ClientSession() as sess:
+            self.assertIsNone(await fetch.race_pdf(sess, urls))
+
+
+class TestResume(LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.pdf = b"%PDF-1.4\n" + os.urandom(256 * 1024)
+        pdf_path = os.path.join(self.out_dir.name, "served.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(self.pdf)
+        self.ranges = []
+        self.interrupted = False
+
+        async def ranged(request):
+            self.ranges.append(request.headers.get("Range"))
+            return web.FileResponse(pdf_path)
+
+        async def no_ranges(request):
+            self.ranges.append(request.headers.get("Range"))
+            return web.Response(body=self.pdf, content_type="application/pdf")
+
+        async def flaky(request):
+            if self.interrupted:
+                return await ranged(request)
+            # send half of the file, then drop the connection
+            self.interrupted = True
+            res = web.StreamResponse(headers={"Content-Type": "application/pdf"})
+            res.content_length = len(self.pdf)
+            await res.prepare(request)
+            await res.write(self.pdf[: len(self.pdf) // 2])
+            request.transport.close()
+            return res
+
+        self.server = await self.start_server(
+            {"/ranged.pdf": ranged, "/no-ranges.pdf": no_ranges, "/flaky.pdf": flaky}
+        )
+
+    async def asyncTearDown(self):
+        self.out_dir.cleanup()
+
+    def write_partial(self, path):
+        part_path, journal_path = download.partial_paths(self.out_dir.name, "id")
+        with open(part_path, "wb") as f:
+            f.write(self.pdf[:1000])
+        download.write_journal(journal_path, {"url": str(self.server.make_url(path))})
+
+    def assert_downloaded(self, path):
+        self.assertEqual(
+            os.path.basename(path), hashlib.md5(self.pdf).hexdigest() + ".pdf"
+        )
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.pdf)
+        self.assertFalse(
+            any(name.startswith(".") for name in os.listdir(self.out_dir.name))
+        )
+
+    async def test_resume_with_range(self):
+        self.write_partial("/ranged.pdf")
+        async with aiohttp.ClientSession() as sess:
+            path, _ = await download.resume(sess, self.out_dir.name, "id")
+        self.assertEqual(self.ranges, ["bytes=1000-"])
+        self.assert_downloaded(path)
+
+    async def test_resume_without_range_support(self):
+        self.write_partial("/no-ranges.pdf")
+        async with aiohttp.ClientSession() as sess:
+            path, _ = await download.resume(sess, self.out_dir.name, "id")
+        self.assert_downloaded(path)
+
+    async def test_resume_interrupted_download(self):
+        url = str(self.server.make_url("/flaky.pdf"))
+        async with aiohttp.ClientSession() as sess:
+            res, url, head = await fetch.race_pdf(sess, [url])
+            path = await download.download(
+                sess, res, url, head, self.out_dir.name, "id"
+            )
+            res.release()
+        self.assertEqual(len(self.ranges), 1)
+        self.assertTrue(self.ranges[0].startswith("bytes="))
+        self.assert_downloaded(path)
+
+
+class TestPaperStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = PaperStore(os.path.join(self.dir.name, "store"))
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_checkout(self):
+        pdf = b"%PDF-1.4\n"
+        digest = hashlib.md5(pdf).hexdigest()
+        path = os.path.join(self.dir.name, "Paper Title.pdf")
+        with open(path, "wb") as f:
+            f.write(pdf)
+
+        self.assertIsNone(self.store.checkout("10.1016/j.cub.2019.11.030", "out"))
+        self.store.add("10.1016/j.cub.2019.11.030", path, digest, "https://a/b.pdf")
+
+        out_dir = os.path.join(self.dir.name, "out")
+        new_path, url = self.store.checkout(
+            "https://doi.org/10.1016/J.CUB.2019.11.030", out_dir
+        )
+        self.assertEqual(new_path, os.path.join(out_dir, "Paper Title.pdf"))
+        self.assertEqual(url, "https://a/b.pdf")
+        self.assertTrue(os.path.samefile(new_path, self.store.blob_path(digest)))
+
+        # checking the paper out again leaves nothing else behind
+        self.assertEqual(
+            self.store.checkout("10.1016/j.cub.2019.11.030", out_dir),
+            (new_path, "https://a/b.pdf"),
+        )
+        self.assertEqual(os.listdir(out_dir), ["Paper Title.pdf"])
+
+
+class TestMetadata(unittest.TestCase):
+    def test_extract_metadata(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "paper.pdf")
+            with fitz.open() as doc:
+                page = doc.new_page()
+                page.insert_text((72, 72), "Parrots Help Each Other", fontsize=20)
+                page.insert_text((72, 120), "doi:10.1016/j.cub.2019.11.030")
+                doc.set_metadata({"title": "Microsoft Word - draft.docx"})
+                doc.save(path)
+
+            self.assertEqual(
+                metadata.extract_metadata(path),
+                {
+                    "doi": "10.1016/j.cub.2019.11.030",
+                    "title": "Parrots Help Each Other",
+                },
+            )
+            self.assertEqual(
+                metadata.extract_metadata(path, find_doi=False),
+                {"doi": None, "title": "Parrots Help Each Other"},
+            )
+
+
+class TestBatch(unittest.TestCase):
+    def test_read_identifiers(self):
+        lines = [
+            "10.1016/j.cub.2019.11.030\n",
+            "\n",
+            '{"id": "10.1107/s0907444905036693", "type": "doi"}\n',
+            "978-1-60198-482-1,isbn\n",
+            "10.1109/83.544569,doi,tests/documents/bsp-tree.html\n",
+            "10.1109/83.544569,doi,papers/a,b.html\n",
+            "https://example.com/a,b.pdf\n",
+            "arXiv:2407.13619",
+        ]
+        self.assertEqual(
+            list(read_identifiers(lines)),
+            [
+                "10.1016/j.cub.2019.11.030",
+                "10.1107/s0907444905036693",
+                "978-1-60198-482-1",
+                "10.1109/83.544569",
+                "10.1109/83.544569",
+                "https://example.com/a,b.pdf",
+                "arXiv:2407.13619",
+            ],
+        )
+
+
+class TestFetchBatch(
+    ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase
+):
+    async def asyncSetUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+
+        async def pdf(request):
+            body = b"%PDF-1.4\n" + request.match_info["name"].encode()
+            return web.Response(body=body, content_type="application/pdf")
+
+        self.server = await self.start_server({"/{name}.pdf": pdf})
+
+    async def asyncTearDown(self):
+        self.out_dir.cleanup()
+
+    async def test_lazy_rename(self):
+        urls = [str(self.server.make_url(f"/{name}.pdf")) for name in ("a", "b")]
+
+        def find_title(path):
+            with open(path, "rb") as f:
+                return "Title " + f.read()[-1:].decode()
+
+        with mock.patch.object(fetch, "find_title", find_title):
+            async with aiohttp.ClientSession() as sess:
+                results = [
+                    result
+                    async for result in fetch_batch(
+                        sess, urls, "all", self.out_dir.name, rename="lazy"
+                    )
+                ]
+
+        self.assertCountEqual(
+            [(result["id"], os.path.basename(result["path"])) for result in results],
+            [(urls[0], "Title a.pdf"), (urls[1], "Title b.pdf")],
+        )
+
+    async def test_failed_rename(self):
+        urls = [str(self.server.make_url(f"/{name}.pdf")) for name in ("a", "b")]
+
+        async def rename_paper(identifier, path, *args):
+            raise OSError("disk full")
+
+        with mock.patch.object(fetch, "rename_paper", rename_paper):
+            async with aiohttp.ClientSession() as sess:
+                results = [
+                    result
+                    async for result in fetch_batch(
+                        sess, urls, "all", self.out_dir.name, rename="lazy"
+                    )
+                ]
+
+        # the papers are still reported, under the names they were saved with
+        self.assertCountEqual([result["id"] for result in results], urls)
+        for result in results:
+            self.assertTrue(os.path.exists(result["path"]))
+
+    async def test_results_while_reading(self):
+        urls = [str(self.server.make_url(f"/{name}.pdf")) for name in ("a", "b")]
+        first_result = asyncio.Event()
+
+        async def identifiers():
+            yield urls[0]
+            # like a pipe that only sends the next line later
+            await first_result.wait()
+            yield urls[1]
+
+        results = []
+        async with asyncio.timeout(5), aiohttp.ClientSession() as sess:
+            async for result in fetch_batch(
+                sess, identifiers(), "all", self.out_dir.name, rename="none"
+            ):
+                results.append(result["id"])
+                first_result.set()
+
+        self.assertEqual(results, urls)
+
+
+class TestMetrics(ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pdf = b"%PDF-1.4\n" + b"0" * 4096
+
+        async def pdf(request):
+            return web.Response(body=self.pdf, content_type="application/pdf")
+
+        self.server = await self.start_server({"/paper.pdf": pdf})
+
+    def test_disabled(self):
+        run_metrics = metrics.get_metrics()
+        with run_metrics.span("stage"):
+            run_metrics.count("requests")
+        self.assertEqual(run_metrics.stages, {})
+        self.assertEqual(run_metrics.counters, {})
+
+    def test_prometheus(self):
+        run_metrics = metrics.get_metrics()
+        run_metrics.enabled = True
+        run_metrics.record("stage", 0.02)
+        run_metrics.record("stage", 3.0)
+        run_metrics.count("requests", 2)
+
+        lines = run_metrics.prometheus().splitlines()
+        self.assertIn(
+            'papers_dl_stage_seconds_bucket{stage="stage",le="0.01"} 0', lines
+        )
+        self.assertIn(
+            'papers_dl_stage_seconds_bucket{stage="stage",le="0.025"} 1', lines
+        )
+        self.assertIn('papers_dl_stage_seconds_bucket{stage="stage",le="5"} 2', lines)
+        self.assertIn('papers_dl_stage_seconds_count{stage="stage"} 2', lines)
+        self.assertIn("papers_dl_requests_total 2", lines)
+
+    async def test_fetch_stages(self):
+        run_metrics = metrics.get_metrics()
+        run_metrics.enabled = True
+        run_metrics.tracing = True
+
+        url = str(self.server.make_url("/paper.pdf"))
+        with tempfile.TemporaryDirectory() as out_dir:
+            async with session.create_session() as sess:
+                result = await fetch.download_paper(
+                    sess, url, "all", out_dir, rename=False
+                )
+        self.assertIsNotNone(result)
+
+        summary = run_metrics.summary()
+        for stage in ("paper", "fetch.resume", "fetch.race", "fetch.download"):
+            self.assertEqual(summary["stages"][stage]["count"], 1)
+        self.assertEqual(summary["counters"]["requests"], 1)
+        self.assertEqual(summary["counters"]["papers_downloaded"], 1)
+        self.assertEqual(summary["counters"]["pdf_bytes"], len(self.pdf))
+        # spans are kept in the order they ended
+        self.assertEqual(run_metrics.spans[-1]["name"], "paper")
@@ -1,5 +1,12 @@
+import concurrent.futures
+import glob
+import io
 import os
+import random
+import re
+import tempfile
 import unittest
+from unittest import mock
 
 from parse import parse
 
@@ -53,6 +60,197 @@ class TestParser(unittest.TestCase):
                 html_content = f.read()
                 pdf_url = parse.find_pdf_url(html_content)
             self.assertEqual(pdf_url, expected_url)
+            # pages straight off the network are bytes
+            pdf_url = parse.find_pdf_url(html_content.encode())
+            self.assertEqual(pdf_url, expected_url)
+
+        html_content = """
+            <iframe src="/ad.html"></iframe>
+            <IFRAME title="a > b" TYPE="application/pdf" SRC="/paper.pdf">
+        """
+        self.assertEqual(parse.find_pdf_url(html_content), "/paper.pdf")
+        self.assertIsNone(parse.find_pdf_url("<html><body>no PDF</body></html>"))
+
+        # markers in comments, text and script strings aren't links
+        html_content = """
+            <!-- <embed id="pdf" type="application/pdf" src="/c.pdf"> -->
+            <p>PDFObject.embed("/fake.pdf")</p>
+            <script>var tag = '<iframe type="application/pdf" src="/s.pdf">';</script>
+        """
+        self.assertIsNone(parse.find_pdf_url(html_content))
+        html_content += '<embed id="pdf" type="application/pdf" src="/real.pdf">'
+        self.assertEqual(parse.find_pdf_url(html_content), "/real.pdf")
+        html_content += '<script>PDFObject.embed("/object.pdf", "#pdf");</script>'
+        self.assertEqual(parse.find_pdf_url(html_content), "/object.pdf")
+
+    def test_pdf_link_finder(self):
+        "Test that PDF links are found in pages that arrive in chunks."
+
+        for file, expected_url in test_document_links:
+            with open(os.path.join(TestParser.test_material_dir, file), "rb") as f:
+                page = f.read()
+            for chunk_size in (1, 7, 64, len(page)):
+                finder = parse.PDFLinkFinder()
+                pdf_url = None
+                for i in range(0, len(page), chunk_size):
+                    pdf_url = finder.feed(page[i : i + chunk_size])
+                    if pdf_url is not None:
+                        break
+                else:
+                    pdf_url = finder.close()
+                self.assertEqual(pdf_url, expected_url, f"{file} ({chunk_size})")
+
+        # a PDFObject further down outranks an iframe that came first
+        page = b"""
+            <iframe type="application/pdf" src="/preview.pdf"></iframe>
+            <script>PDFObject.embed("/full.pdf", "#pdf");</script>
+        """
+        finder = parse.PDFLinkFinder()
+        self.assertIsNone(finder.feed(page[:80]))
+        self.assertEqual(finder.feed(page[80:]), "/full.pdf")
+        finder = parse.PDFLinkFinder()
+        self.assertIsNone(finder.feed(page[:80]))
+        # nothing can outrank the iframe once the page has ended
+        self.assertEqual(finder.feed(b"</html>"), "/preview.pdf")
+
+    def test_parse_stream(self):
+        "Test that ids split across chunks are found when streaming."
+
+        text = " ".join(
+            open(path).read()
+            for path in sorted(glob.glob(f"{TestParser.test_material_dir}/*"))
+        )
+        expected = parse.parse_ids_from_text(text)
+        with mock.patch.object(parse, "MAX_ID_LENGTH", 100):
+            for chunk_size in (1, 7, 50, 333):
+                stream = io.StringIO(text)
+                # ids come out chunk by chunk, so only the order differs
+                self.assertCountEqual(
+                    list(parse.parse_stream(stream, chunk_size=chunk_size)), expected
+                )
+
+    def test_parse_stream_pipe(self):
+        "Test that ids are yielded before a pipe is closed."
+
+        r, w = os.pipe()
+        with os.fdopen(r) as stream, os.fdopen(w, "w") as writer:
+            writer.write("doi: 10.1109/83.544569\nand")
+            writer.flush()
+            ids = parse.parse_stream(stream)
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                first = executor.submit(next, ids)
+                try:
+                    self.assertEqual(
+                        first.result(timeout=5),
+                        {"id": "10.1109/83.544569", "type": "doi"},
+                    )
+                finally:
+                    writer.close()
+
+    def test_parse_mmap(self):
+        "Test that scanning raw bytes finds the same ids as scanning text."
+
+        for path in sorted(glob.glob(f"{TestParser.test_material_dir}/*")):
+            with open(path) as f:
+                expected = parse.parse_ids_from_text(f.read())
+            self.assertEqual(list(parse.parse_mmap(path)), expected)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "mixed.txt")
+            with open(path, "wb") as f:
+                f.write(b"\xff\xfe caf\xe9 10.1016/j.cub.2019.11.030 \xe2\x82")
+            self.assertEqual(
+                list(parse.parse_mmap(path)),
+                [{"id": "10.1016/j.cub.2019.11.030", "type": "doi"}],
+            )
+
+    def test_parse_pdf(self):
+        "Test that ids are found in the text of PDFs, on their own and in directories."
+
+        import fitz
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "paper.pdf")
+            with fitz.open() as doc:
+                doc.new_page().insert_text((72, 72), "doi: 10.1016/j.cub.2019.11.030")
+                doc.new_page()
+                doc.new_page().insert_text((72, 72), "arXiv:2407.13619")
+                doc.save(path)
+            with open(os.path.join(dir, "notes.txt"), "w") as f:
+                f.write("see 10.1038/s41586-020-2649-2")
+
+            self.assertTrue(parse.is_pdf(path))
+            self.assertEqual(
+                list(parse.scan_file(path, ["doi", "arxiv"])),
+                [
+                    {"id": "10.1016/j.cub.2019.11.030", "type": "doi"},
+                    {"id": "arXiv:2407.13619", "type": "arxiv"},
+                ],
+            )
+
+            matches, error = parse.parse_path(path, ["doi"])
+            self.assertIsNone(error)
+            self.assertEqual(
+                matches, [{"id": "10.1016/j.cub.2019.11.030", "type": "doi"}]
+            )
+
+            found = parse.parse_files([dir], ["doi"], workers=1)
+            self.assertEqual(
+                sorted(match["id"] for match in found),
+                ["10.1016/j.cub.2019.11.030", "10.1038/s41586-020-2649-2"],
+            )
+
+    def test_same_ids_as_separate_patterns(self):
+        """
+        Test that ids are found as by running each pattern over the text on
+        its own, in the same order.
+        """
+
+        def find_ids(s):
+            seen = set()
+            ids = []
+            for id_type, regexes in parse.id_patterns.items():
+                validator = parse.id_validators.get(id_type)
+                for regex in regexes:
+                    for match in re.finditer(regex, s, re.IGNORECASE):
+                        mg = match.group()
+                        if mg not in seen and (validator is None or validator(mg)):
+                            ids.append({"id": mg, "type": id_type})
+                        seen.add(mg)
+            return ids
+
+        pieces = ["10.", "1234", "/", "ISBN ", "978", "0-306-40615-2", "arXiv:"]
+        pieces += ["hep-th", "2407.13619", "-", " ", ".", "x", "7", "\n"]
+        texts = ["10.1234/ISBN 0-306-40615-2", "978-0-306-40615-7 10.1002/x"]
+        rng = random.Random(0)
+        for _ in range(2000):
+            texts.append("".join(rng.choices(pieces, k=rng.randint(1, 30))))
+
+        for text in texts:
+            self.assertEqual(parse.parse_ids_from_text(text), find_ids(text), text)
+
+    def test_normalize_id(self):
+        same_ids = [
+            ("10.1016/j.cub.2019.11.030", "https://doi.org/10.1016/J.CUB.2019.11.030"),
+            ("arXiv:2407.13619", "arxiv:2407.13619"),
+            ("arXiv:2407.13619v2", "2407.13619v2"),
+            ("978-1-60198-482-1", "ISBN-13: 9781601984821"),
+        ]
+        for a, b in same_ids:
+            self.assertEqual(parse.normalize_id(a), parse.normalize_id(b))
+
+    def test_classify_id(self):
+        ids = [
+            ("https://dx.doi.org/10.1016/j.cub.2019.11.030", "doi"),
+            ("arXiv:hep-th/0512302", "arxiv"),
+            ("2407.13619", "arxiv"),
+            ("1605.04938v3", "arxiv"),
+            ("978-1-60198-482-1", "isbn"),
+            ("see 10.1016/j.cub.2019.11.030", None),
+            ("12345", None),
+        ]
+        for id, id_type in ids:
+            self.assertEqual(parse.classify_id(id), id_type, id)
 
 
 test_document_ids = {
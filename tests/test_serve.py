@@ -0,0 +1,73 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from serve import PaperService, create_app
+from tests import LocalServerMixin, ResetStateMixin
+
+
+class TestServe(ResetStateMixin, LocalServerMixin, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.downloads = 0
+
+        async def pdf(request):
+            self.downloads += 1
+            await asyncio.sleep(0.2)
+            return web.Response(body=b"%PDF-1.4\n", content_type="application/pdf")
+
+        self.pdf_server = await self.start_server({"/paper.pdf": pdf})
+
+        service = PaperService(out_dir=self.out_dir.name, rename=False)
+        self.client = TestClient(TestServer(create_app(service)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.out_dir.cleanup()
+
+    async def test_fetch_coalesced(self):
+        url = str(self.pdf_server.make_url("/paper.pdf"))
+        responses = await asyncio.gather(
+            *(self.client.post("/fetch", json={"id": url}) for _ in range(3))
+        )
+        results = [await res.json() for res in responses]
+
+        # every request got the paper from a single download
+        self.assertEqual(self.downloads, 1)
+        self.assertEqual([res.status for res in responses], [200] * 3)
+        self.assertEqual(len({result["path"] for result in results}), 1)
+        self.assertEqual(results[0]["url"], url)
+        self.assertTrue(os.path.exists(results[0]["path"]))
+
+    async def test_fetch_errors(self):
+        res = await self.client.post("/fetch", data="not json")
+        self.assertEqual(res.status, 400)
+        res = await self.client.post("/fetch", json={"ids": []})
+        self.assertEqual(res.status, 400)
+
+    async def test_parse(self):
+        res = await self.client.post(
+            "/parse", json={"text": "see 10.1109/83.544569", "types": ["doi"]}
+        )
+        self.assertEqual(
+            await res.json(), {"ids": [{"id": "10.1109/83.544569", "type": "doi"}]}
+        )
+
+        res = await self.client.post(
+            "/parse", json={"path": "tests/documents/bsp-tree.html", "types": ["doi"]}
+        )
+        self.assertIn(
+            {"id": "10.1109/83.544569", "type": "doi"}, (await res.json())["ids"]
+        )
+
+        res = await self.client.post("/parse", json={"text": "", "types": ["x"]})
+        self.assertEqual(res.status, 400)
+
+    async def test_metrics(self):
+        res = await self.client.get("/metrics")
+        self.assertEqual(res.status, 200)
+        self.assertIn("papers_dl_stage_seconds histogram", await res.text())